@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Stephen Stokes: sstokes[at]relationshipvelocity.com'
+
+# Imports
+import copy
+import sys
+
+import sf_tdm as tdm
+import tools.helpers as h
+from tools import projection
+
+# Micro-benchmark of relationship flattening in do_upsert: the previous
+# flatten_dict + fix_flattened_fields pass against the compiled projection.
+# Usage: bench_projection.py [n_records]
+
+
+# Previous implementation, kept here for comparison.
+def fix_flattened_fields(relationships, fields, data):
+    for rel in relationships:
+        fields.append(f'{rel["relationship_name"]}_{rel["external_id"]}')
+
+    for rec in data:
+        {rec.pop(key) for key in list(rec.keys())
+         if key not in fields}
+
+        for rel in relationships:
+            reln_underscore_reference = f'{rel["relationship_name"]}_{rel["external_id"]}'
+            reln_dot_reference = f'{rel["relationship_name"]}.{rel["external_id"]}'
+            if reln_underscore_reference in rec:
+                rec[f'{rel["relationship_name"]}.{rel["external_id"]}'] = rec.pop(
+                    reln_underscore_reference)
+            if reln_dot_reference not in rec:
+                rec.update({reln_dot_reference: None})
+    return data
+
+
+# Code
+n_records = (int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
+relationships = [
+    {'field': 'AccountId', 'relationship_name': 'Account',
+        'external_id': 'UUID__c', 'object': 'Account'},
+    {'field': 'ReportsToId', 'relationship_name': 'ReportsTo',
+        'external_id': 'UUID__c', 'object': 'Contact'},
+    {'field': 'OwnerId', 'relationship_name': 'Owner',
+        'external_id': 'Legacy_ID__c', 'object': 'User'}
+]
+fields = ['UUID__c', 'FirstName', 'LastName', 'Email', 'Phone', 'Title',
+          'AccountId', 'ReportsToId', 'OwnerId']
+records = [{'UUID__c': str(x), 'FirstName': 'First', 'LastName': f'Last {x}', 'Email': f'{x}@example.com',
+            'Phone': '555-0100', 'Title': 'Tester',
+            'Account': {'attributes': {'type': 'Account'}, 'UUID__c': f'a{x % 1000}'},
+            'ReportsTo': (None if x % 2 else {'attributes': {'type': 'Contact'}, 'UUID__c': f'c{x - 1}'}),
+            'Owner': {'attributes': {'type': 'User'}, 'Legacy_ID__c': 'u1'}}
+           for x in range(n_records)]
+print(f'{n_records} records, {len(fields)} fields, {len(relationships)} relationships')
+
+data = copy.deepcopy(records)
+st = h.dtm()
+_fields = tdm.replace_field_external_ids(relationships, list(fields))
+data = [h.flatten_dict(record) for record in data]
+old = fix_flattened_fields(relationships, _fields, data)
+fn = h.dtm()
+print(f'flatten_dict + fix_flattened_fields: {fn-st}')
+
+st = h.dtm()
+upsert_columns = projection.upsert_projection(fields, relationships)
+new = upsert_columns.records(records)
+fn = h.dtm()
+print(f'Projection.records: {fn-st}')
+
+st = h.dtm()
+rows = upsert_columns.rows(records)
+fn = h.dtm()
+print(f'Projection.rows: {fn-st}')
+
+assert old == new, 'Projection does not match the previous flattening.'
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Stephen Stokes: sstokes[at]relationshipvelocity.com'
+
+# Imports
+import gc
+import json
+import sys
+import tracemalloc
+
+import tools.helpers as h
+from tools import projection, records
+
+# Micro-benchmark of REST query page decoding: the previous response.json() and
+# attributes comprehension against decode_page, with dictionaries and with
+# compact Rows. Reports decode time and memory held by the decoded records.
+# Each timing starts with no earlier results held and a collected heap, runs
+# with the garbage collector off, and the best of `repeat` runs is reported.
+# Usage: bench_records.py [n_records] [n_fields]
+
+
+# Previous implementation, kept here for comparison.
+def decode_page_dicts(content):
+    results = json.loads(content)
+    return [{key: value for key, value in record.items() if key != 'attributes'}
+            for record in results['records']]
+
+
+# Return the best decode time of pages over repeat runs.
+def timed(decode, pages, repeat=3):
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        gc.disable()
+        st = h.dtm()
+        decoded = [decode(page) for page in pages]
+        fn = h.dtm()
+        gc.enable()
+        del decoded
+        best = (fn - st if best is None else min(best, fn - st))
+    return best
+
+
+# Return the bytes per record held by the decoded pages.
+def traced_size(decode, pages):
+    gc.collect()
+    tracemalloc.start()
+    decoded = [decode(page) for page in pages]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size / sum(len(page) for page in decoded)
+
+
+# Code
+n_records = (int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
+n_fields = (int(sys.argv[2]) if len(sys.argv) > 2 else 40)
+print(f'{n_records} records, {n_fields} fields, orjson: {records.orjson is not None}')
+pages = [json.dumps({'totalSize': n_records, 'done': True, 'records': [
+    dict({'attributes': {'type': 'Contact', 'url': f'/services/data/v48.0/sobjects/Contact/003{x}'},
+          'UUID__c': str(x),
+          'Account': {'attributes': {'type': 'Account', 'url': '/services/data/v48.0/sobjects/Account/001'},
+                      'UUID__c': f'a{x % 1000}'}},
+         **{f'Field_{i}__c': (None if i % 3 else f'value {x}') for i in range(n_fields)})
+    for x in range(start, min(start + 2000, n_records))]}).encode('utf-8')
+    for start in range(0, n_records, 2000)]
+
+schemas = {}
+decoders = [('response.json() + comprehension', decode_page_dicts),
+            ('decode_page', lambda page: records.decode_page(page)['records']),
+            ('decode_page compact', lambda page: records.decode_page(page, True, schemas)['records'])]
+# Memory is traced after all timings: tracing slows decoding down and skews later timings.
+seconds = [timed(decode, pages) for label, decode in decoders]
+for (label, decode), best in zip(decoders, seconds):
+    print(f'{label}: {best}, {traced_size(decode, pages):.0f} bytes/record')
+
+columns = projection.Projection(['UUID__c', 'Account.UUID__c'] + [f'Field_{i}__c' for i in range(n_fields)])
+assert all(columns.rows(decode_page_dicts(page)) == columns.rows(records.decode_page(page, True)['records'])
+           for page in pages), 'Compact rows do not project like the previous records.'
@@ -18,6 +18,12 @@ log.debug(f'{__name__} logging is configured.')
 @h.exception(log)
 @h.timer(log)
 def run_template():
+    # Resume an interrupted run: run_template.py --resume <run-id>
+    if sys.argv[1] == '--resume':
+        return tdm.run_template(resume=sys.argv[2])
+    # Estimate a run from count() queries only: run_template.py --plan <template> [target]
+    if sys.argv[1] == '--plan':
+        return tdm.plan_template(sys.argv[2], target=(sys.argv[3] if len(sys.argv) > 3 else None))
     config = sys.argv[1]
     make_changes = True #(str2bool(sys.argv[2]) if sys.argv[2] else True)
     target = None #(sys.argv[3] if sys.argv[3] else None)
@@ -5,8 +5,10 @@ __author__ = 'Stephen Stokes: sstokes[at]relationshipvelocity.com'
 
 import json
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 import tools.helpers as h
+from tools import scheduler
 
 # Logging statements for each module:
 log = logging.getLogger(__name__)
@@ -16,7 +18,7 @@ log.debug(f'{__name__} logging is configured.')
 # Primary function
 @h.exception(log)
 @h.timer(log)
-def create_template(source_org, operations_list, output, ext_id_file, fields=None):
+def create_template(source_org, operations_list, output, ext_id_file, fields=None, counts=True, workers=10):
     log.info(f'source: {source_org} > output: {output}')
 
     ext_id = h.get_config(ext_id_file)
@@ -28,7 +30,7 @@ def create_template(source_org, operations_list, output, ext_id_file, fields=Non
     obj_list = list(dict.fromkeys([d['object']
                                    for d in opr_list['operations']]))
 
-    all_fields = get_object_data(source_org, obj_list, fields)
+    all_fields = get_object_data(source_org, obj_list, fields, workers)
 
     fields = []
     for fld in all_fields:
@@ -66,25 +68,34 @@ def create_template(source_org, operations_list, output, ext_id_file, fields=Non
 
         template_data.append(_template)
 
+    # Annotate rows with their source record counts, used to load large objects early.
+    if counts:
+        get_record_counts(source_org, template_data, workers)
+    template_data = order_template(template_data)
+
     # log.debug(f'template: {template_data}')
 
     with open(output, 'w') as json_file:
         json.dump(template_data, json_file)
 
+    h.pool.close_all()
+
     return f'create_template completed.'
 
 
 # Functions
 @h.exception(log)
 @h.timer(log)
-def get_object_data(source_org, obj_list, fields=None):
-    sf_rest = h.get_sf_rest_connection(source_org)
+def get_object_data(source_org, obj_list, fields=None, workers=10):
+    sf_rest = h.pool.rest(source_org)
 
     # Mass describe
     all_fields = []
     if fields:
         all_fields = h.get_config(fields)
     else:
+        # Describe all objects concurrently; unchanged describes come from the describe cache.
+        sf_rest.describe_objects(obj_list, workers)
         for obj in obj_list:
             all_fields.extend(sf_rest.describe_fields(obj))
 
@@ -111,12 +122,68 @@ def get_object_data(source_org, obj_list, fields=None):
     with open('./output/fields_1.json', 'w') as json_file:
         json.dump(fields, json_file)
 
-    sf_rest.close_connection()
     log.info(f'get_object_data finished - record count: {len(fields)}.')
 
     return fields
 
 
+# Set estimated_records of each template row to its source count() (with the row's where and limit).
+@h.exception(log)
+@h.timer(log)
+def get_record_counts(source_org, template_data, workers=10):
+    sf_rest = h.pool.rest(source_org)
+
+    def _count(row):
+        query = f'select count() from {row["object"]}' + (f' where {row["where"]}' if row['where'] else '')
+        count = sf_rest.soql_count(query)
+        return (min(count, row['limit']) if row['limit'] > 0 else count)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for row, count in zip(template_data, executor.map(_count, template_data)):
+            row['estimated_records'] = count
+
+    return template_data
+
+
+# Order template rows by their lookup graph: referenced objects load first and
+# larger objects first among those ready. References within a cycle that point
+# to an object loaded later are left out of the row and loaded by a second-pass
+# upsert row once the referenced objects are in; the cycle order minimizes the
+# records loaded twice. Self relationships stay in the row, run_template loads
+# them in its own second pass.
+def order_template(template_data):
+    graph = {}
+    weights = {}
+    for row in template_data:
+        graph.setdefault(row['object'], set()).update(rel['object'] for rel in row['relationships'])
+        weights[row['object']] = (weights[row['object']] if row['object'] in weights else 0) \
+            + (row['estimated_records'] if 'estimated_records' in row else 0)
+    order, back_edges = scheduler.cycle_order(graph, weights)
+
+    rows = sorted(template_data, key=lambda row: order.index(row['object']))
+    second_pass = []
+    for row in rows:
+        if row['object'] not in back_edges or row['operation'] not in ['refresh', 'upsert']:
+            continue
+        later = [rel for rel in row['relationships'] if rel['object'] in back_edges[row['object']]]
+        later_fields = [rel['field'] for rel in later]
+        row['relationships'] = [rel for rel in row['relationships'] if rel['field'] not in later_fields]
+        row['fields'] = [field for field in row['fields'] if field not in later_fields]
+        second_pass.append(dict(row,
+                                operation='upsert',
+                                fields=[row['external_id']] + later_fields,
+                                where=' and '.join(([f'({row["where"]})'] if row['where'] else [])
+                                                   + ['(' + ' or '.join(f'{field} != null'
+                                                                        for field in later_fields) + ')']),
+                                relationships=later,
+                                masks={field: method for field, method in row['masks'].items()
+                                       if field == row['external_id']}))
+    for row in second_pass:
+        log.info(f'{row["object"]} second pass for {[rel["field"] for rel in row["relationships"]]}.')
+
+    return rows + second_pass
+
+
 # Run main program
 if __name__ == '__main__':
     h.setup_logging()
@@ -4,11 +4,18 @@
 __author__ = 'Stephen Stokes: sstokes[at]relationshipvelocity.com'
 
 import csv
+import itertools
 import json
 import logging
+import os
+import shutil
+import threading
+import time
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import tools.helpers as h
+from tools import (bulk_csv, governor, journal, masking, metrics, planner, projection, scheduler, sf_rest_api,
+                   snapshot, tuning, watermarks)
 
 # Logging statements for each module:
 log = logging.getLogger(__name__)
@@ -16,111 +23,592 @@ log.debug(f'{__name__} logging is configured.')
 
 # Global variables
 MAKE_CHANGES = True
+BULK_EXTRACT_THRESHOLD = 100000
+REST_WORKERS = 1
+REST_RANGE_FIELD = 'CreatedDate'
+REST_RANGE_THRESHOLD = 10000
+REST_LOAD_THRESHOLD = 1000
+REST_LOAD_WORKERS = 4
+BULK_SLOTS = None
+MASK_SEED = None
+MASK_WORKERS = 1
+MASK_CHUNK_SIZE = 2000
+WATERMARKS = watermarks.WatermarkStore()
+SNAPSHOTS = None
+# Whether SNAPSHOTS is a run-local cache kept as long as the run journal, which
+# then serves as the spill of checkpointed loads.
+SNAPSHOT_SPILLS = False
+JOURNAL = None
+TUNER = tuning.BulkTuner()
+METRICS = metrics.METRICS
 
 
 # Primary function
 @h.exception(log)
 @h.timer(log)
-def run_template(tdm_config, env_path='./config/', env_config='env.map.json', make_changes=True, target=None):
-    global MAKE_CHANGES
+def run_template(tdm_config=None, env_path='./config/', env_config='env.map.json', make_changes=True, target=None,
+                 parallel=None, concurrency=None, resume=None):
+    global MAKE_CHANGES, MASK_SEED, MASK_WORKERS, SNAPSHOTS, JOURNAL, REST_WORKERS, REST_RANGE_FIELD, \
+        REST_LOAD_THRESHOLD, SNAPSHOT_SPILLS
+    # Resume a previous run with its original settings, skipping completed work.
+    if resume:
+        JOURNAL = journal.RunJournal(resume)
+        settings = JOURNAL.get_settings()
+        tdm_config = settings['tdm_config']
+        env_path = settings['env_path']
+        env_config = settings['env_config']
+        make_changes = settings['make_changes']
+        target = settings['target']
+        parallel = settings['parallel']
+        concurrency = settings['concurrency']
     MAKE_CHANGES = make_changes
     conf = h.confirm(
         prompt='Are the target Org email settings correct?', resp=False)
     if conf == False:
         return 'Please correct email settings and return.'
 
+    METRICS.reset()
     _tdm_config = h.get_config(tdm_config)
     env_map = h.get_config(env_path+env_config)
     log.info(
         f'Successfully read config files: {tdm_config}')
 
     source = (_tdm_config['source'] if 'source' in _tdm_config else 'PRD')
-    target = (_tdm_config['target'] if not target else target)
+    # Several targets, e.g. "targets": ["DEV1", "DEV2"], fan out from one extraction.
+    target = (target if target else
+              _tdm_config['targets'] if 'targets' in _tdm_config else _tdm_config['target'])
+    targets = (list(target) if isinstance(target, list) else [target])
+    # A single element list is a single target.
+    target = (targets[0] if len(targets) == 1 else target)
     data = _tdm_config['data']
+    MASK_SEED = (_tdm_config['mask_seed']
+                 if 'mask_seed' in _tdm_config else None)
+    MASK_WORKERS = (_tdm_config['mask_workers']
+                    if 'mask_workers' in _tdm_config else 1)
+    REST_WORKERS = (_tdm_config['rest_workers']
+                    if 'rest_workers' in _tdm_config else 1)
+    REST_RANGE_FIELD = (_tdm_config['rest_range_field']
+                        if 'rest_range_field' in _tdm_config else 'CreatedDate')
+    # Keep REST query records as compact Rows sharing a field schema instead of dictionaries.
+    sf_rest_api.COMPACT_RECORDS = (_tdm_config['compact_records']
+                                   if 'compact_records' in _tdm_config else False)
+    # Loads of up to this many records use REST sObject Collections instead of a bulk job; 0 disables.
+    REST_LOAD_THRESHOLD = (_tdm_config['rest_load_threshold']
+                           if 'rest_load_threshold' in _tdm_config else 1000)
+    # Share of the orgs' daily API requests and bulk batches the run may use up to.
+    governor.GOVERNOR.budget = (_tdm_config['api_budget']
+                                if 'api_budget' in _tdm_config else 0.9)
+    # Snapshot cache settings, e.g. {"ttl_hours": 24, "max_mb": 2048}; true for defaults.
+    snapshot_config = (_tdm_config['snapshot']
+                       if 'snapshot' in _tdm_config else None)
+    SNAPSHOTS = (snapshot.SnapshotCache(**(snapshot_config if isinstance(snapshot_config, dict) else {}))
+                 if snapshot_config else None)
+    SNAPSHOT_SPILLS = False
+    sf_cfg_source = env_path+env_map[source]
+    sf_cfg_targets = {name: env_path+env_map[name] for name in targets}
+    sf_cfg_target = sf_cfg_targets[targets[0]]
+    # Check the template against the targets' (cached) describes before changing anything.
+    validate_fields = (_tdm_config['validate_fields']
+                       if 'validate_fields' in _tdm_config else True)
+    if validate_fields:
+        for name, _sf_cfg_target in sf_cfg_targets.items():
+            missing = get_missing_fields(data, _sf_cfg_target)
+            if missing:
+                raise ValueError(f'Fields missing in target {name}: {missing}')
+
+    # Checkpointed runs keep a copy of all extracted source data on disk until they complete.
+    checkpoint = (_tdm_config['checkpoint']
+                  if 'checkpoint' in _tdm_config else False)
+    if not resume:
+        JOURNAL = (journal.RunJournal() if checkpoint else None)
+    if JOURNAL is not None and not resume:
+        JOURNAL.save_settings(tdm_config=tdm_config, env_path=env_path, env_config=env_config,
+                              make_changes=make_changes, target=target, parallel=parallel,
+                              concurrency=concurrency)
+    if JOURNAL is not None:
+        log.info(
+            f'Run id {JOURNAL.run_id}; resume with: run_template.py --resume {JOURNAL.run_id}')
+
+    parallel = (_tdm_config['parallel']
+                if parallel is None and 'parallel' in _tdm_config else parallel)
+    concurrency = (_tdm_config['concurrency']
+                   if concurrency is None and 'concurrency' in _tdm_config else concurrency)
+
+    delete_workers = (_tdm_config['delete_workers']
+                      if 'delete_workers' in _tdm_config else 1)
+
+    failed = {}
+    fanout_path = None
+    if len(targets) > 1:
+        if parallel:
+            log.warning('parallel is not supported with several targets, running rows in template order.')
+        # Targets read each row from the snapshot cache; without one, use a run-local cache.
+        if SNAPSHOTS is None:
+            fanout_path = os.path.join('./cache/fanout', (JOURNAL.run_id if JOURNAL is not None else
+                                                          h.dtm().strftime('%Y%m%d-%H%M%S')))
+            SNAPSHOTS = snapshot.SnapshotCache(path=fanout_path, ttl_hours=24 * 365, max_mb=1024 * 1024)
+            SNAPSHOT_SPILLS = (JOURNAL is not None)
+        failed = run_fanout(data, sf_cfg_source, sf_cfg_targets, source, delete_workers)
+    elif parallel:
+        run_rows_parallel(data, sf_cfg_source, sf_cfg_target,
+                          source, target, concurrency or 20)
+    else:
+        # Run all deletes up front, independent objects in parallel.
+        if delete_workers > 1:
+            run_deletes(data, sf_cfg_source, sf_cfg_target,
+                        source, target, delete_workers)
+        steps = (('load',) if delete_workers > 1 else ('delete', 'load'))
+        for i, row in enumerate(data):
+            run_row(row, sf_cfg_source, sf_cfg_target,
+                    source, target, steps=steps, row_key=f'{i}.{row["object"]}')
+
+    h.pool.close_all()
+    # Run report of per object and phase durations, throughput and API usage.
+    report = (_tdm_config['report'] if 'report' in _tdm_config else True)
+    if report:
+        METRICS.write(path=(report if isinstance(report, str) else './reports'),
+                      name=(JOURNAL.run_id if JOURNAL is not None else None),
+                      openmetrics=(_tdm_config['openmetrics'] if 'openmetrics' in _tdm_config else False))
+    if failed:
+        # Keep the journal and fan-out cache so the failed targets can be resumed;
+        # without a journal there is nothing to resume.
+        log.error(f'Failed targets: {failed}')
+        if fanout_path and JOURNAL is None:
+            shutil.rmtree(fanout_path, ignore_errors=True)
+        SNAPSHOTS = None
+        SNAPSHOT_SPILLS = False
+        JOURNAL = None
+        return f'Completed {tdm_config} template run; failed targets: {", ".join(failed)}.'
+    if fanout_path:
+        shutil.rmtree(fanout_path, ignore_errors=True)
+        SNAPSHOTS = None
+        SNAPSHOT_SPILLS = False
+    if JOURNAL is not None:
+        JOURNAL.close()
+        JOURNAL = None
+
+    return f'Completed {tdm_config} template run.'
+
+
+# Dry-run planning: estimate a template run from count() queries and describe
+# calls only. Reports the records to delete and load, bulk batches, API calls
+# and duration of each row (from learned and reported throughput of previous
+# runs), and whether the run fits the orgs' remaining daily limits and storage.
+@h.exception(log)
+@h.timer(log)
+def plan_template(tdm_config, env_path='./config/', env_config='env.map.json', target=None, path='./plans'):
+    global REST_LOAD_THRESHOLD
+    _tdm_config = h.get_config(tdm_config)
+    env_map = h.get_config(env_path+env_config)
+    source = (_tdm_config['source'] if 'source' in _tdm_config else 'PRD')
+    # A fan-out template is planned against its first target.
+    target = (target if target else
+              _tdm_config['targets'][0] if 'targets' in _tdm_config else _tdm_config['target'])
+    budget = (_tdm_config['api_budget'] if 'api_budget' in _tdm_config else 0.9)
+    REST_LOAD_THRESHOLD = (_tdm_config['rest_load_threshold']
+                           if 'rest_load_threshold' in _tdm_config else 1000)
     sf_cfg_source = env_path+env_map[source]
     sf_cfg_target = env_path+env_map[target]
+    sf_source = h.pool.rest(sf_cfg_source)
+    sf_target = h.pool.rest(sf_cfg_target)
+    target_org = get_org_name(sf_cfg_target)
+    report = (_tdm_config['report'] if 'report' in _tdm_config else True)
+    throughput = planner.report_throughput(report if isinstance(report, str) else './reports')
 
-    for row in data:
-        row_start_time = h.dtm()
+    def _extract_mode(mode, n_records):
+        if mode == 'auto':
+            return ('bulk' if n_records >= BULK_EXTRACT_THRESHOLD else 'rest')
+        return mode
+
+    missing = get_missing_fields(_tdm_config['data'], sf_cfg_target)
+    rows = []
+    for i, row in enumerate(_tdm_config['data']):
         operation = row['operation']
         obj = row['object']
-        thread = (row['bulk_thread'] if 'bulk_thread' in row else True)
-        primary_key = (row['primary_key'] if 'primary_key' in row else 'Id')
-        external_id = (row['external_id']
-                       if 'external_id' in row else 'UUID__c')
-        fields = (row['fields'] if 'fields' in row else [])
+        if operation in ['delete', 'execute']:
+            continue
         where = (row['where'] if 'where' in row else '')
-        order_by = (row['order_by'] if 'order_by' in row else '')
         limit = (row['limit'] if 'limit' in row else 0)
-        relationships = (row['relationships']
-                         if 'relationships' in row else [])
-        masks = (row['masks'] if 'masks' in row else {})
+        external_id = (row['external_id'] if 'external_id' in row else 'UUID__c')
+        relationships = list(row['relationships'] if 'relationships' in row else [])
+        extract_mode = (row['extract_mode'] if 'extract_mode' in row else 'rest')
+        hard_delete = (row['hard_delete'] if 'hard_delete' in row else False)
+        delete_type = ('HardDelete' if hard_delete else 'Delete')
+        bulk_api = (row['bulk_api'] if 'bulk_api' in row else None)
 
-        log.info(f'{obj} {operation} -- {source}>>{target} started...')
-        # Continue if future operations are specified.
-        if operation in ['delete', 'execute']:
-            log.info(
-                f'{operation} is a future operation.  Not currently supported.')
-            continue
-        # Perform delete portion of refresh operation and deleteAll operation.
+        n_delete, n_load = None, None
         if operation in ['refresh', 'deleteAll']:
-            delete_data = get_data(sf_cfg_target, obj, [primary_key])
-            if delete_data:
-                do_bulk_job(sf_cfg_target=sf_cfg_target,
-                            job_type='Delete',
-                            object_name=obj,
-                            data=delete_data,
-                            thread=thread)
-        # Perform upsert portion of refresh operation and insert operation.
-        if operation in ['refresh', 'upsert']:
-            # Split relationships into two lists: self and other.
-            self_relationships = []
-            if relationships:
-                for relationship in relationships:
-                    if relationship['object'] == obj:
-                        self_relationships.append(relationship)
-                        relationships.remove(relationship)
-                        if relationship['field'] in fields:
-                            fields.remove(relationship['field'])
-            log.debug(f'Self relationships: {self_relationships}')
-            log.debug(f'Other relationships: {relationships}')
-            log.debug(f'fields after removing self_relationships: {fields}')
-            # Upsert without self-relationships.
-            do_upsert(sf_cfg_source=sf_cfg_source,
-                      sf_cfg_target=sf_cfg_target,
-                      relationships=relationships,
-                      external_id=external_id,
-                      object_name=obj,
-                      fields=fields,
-                      where=where,
-                      order_by=order_by,
-                      limit=limit,
-                      masks=masks,
-                      thread=thread)
-            # Upsert self relationships.
-            if len(self_relationships) > 0:
-                _flds, _where = get_self_reln_fields_where(
-                    where, self_relationships, external_id)
-                do_upsert(sf_cfg_source=sf_cfg_source,
-                          sf_cfg_target=sf_cfg_target,
-                          relationships=self_relationships,
-                          external_id=external_id,
-                          object_name=obj,
-                          fields=_flds,
-                          where=_where,
-                          order_by=order_by,
-                          limit=limit,
-                          masks=masks,
-                          thread=thread)
-            # Get record count of target object.
-            target_data = get_data(sf_cfg_target, obj, [
-                                   f'count({primary_key}) Ct'])
-            log.debug(f'{obj} final count: {target_data}')
-        row_end_time = h.dtm()
+            n_delete = sf_target.soql_count(build_soql(obj, ['count()']))
+        if operation in ['refresh', 'upsert', 'incremental']:
+            if operation == 'incremental':
+                watermark_field = (row['watermark_field'] if 'watermark_field' in row else 'SystemModstamp')
+                where = incremental_where(where, watermark_field, WATERMARKS.get(source, target, obj))
+            n_load = sf_source.soql_count(build_soql(obj, ['count()'], where))
+            n_load = (min(n_load, limit) if limit > 0 else n_load)
+            # Self relationships are loaded in a second pass.
+            self_relationships = [relationship for relationship in relationships
+                                  if relationship['object'] == obj]
+            if self_relationships:
+                _flds, _where = get_self_reln_fields_where(where, self_relationships, external_id)
+                n_self = sf_source.soql_count(build_soql(obj, ['count()'], _where))
+                n_load += (min(n_self, limit) if limit > 0 else n_self)
+
+        estimate = planner.estimate_row(
+            obj, operation, n_load, n_delete,
+            load_extract=_extract_mode(extract_mode, n_load or 0),
+            delete_extract=_extract_mode((row['extract_mode'] if 'extract_mode' in row else 'auto'), n_delete or 0),
+            load_chunk=TUNER.settings(target_org, obj, 'Upsert', n_load)[0],
+            delete_chunk=TUNER.settings(target_org, obj, delete_type, n_delete)[0],
+            throughput=throughput,
+            load_rate=TUNER.throughput(target_org, obj, 'Upsert'),
+            delete_rate=TUNER.throughput(target_org, obj, delete_type),
+            load_rest=(n_load is not None and use_rest_load('Upsert', bulk_api, n_load)),
+            delete_rest=(n_delete is not None and use_rest_load(delete_type, bulk_api, n_delete)))
+        # Fields the target object does not have would fail the load.
+        if n_load is not None:
+            estimate['missing_fields'] = (missing[f'{i}.{obj}'] if f'{i}.{obj}' in missing else [])
+        rows.append(estimate)
+
+    # Planning calls count against the limits too; they are read last.
+    source_calls = sum(row['source_api_calls'] for row in rows)
+    target_calls = sum(row['target_api_calls'] for row in rows)
+    checks = []
+    if sf_cfg_source == sf_cfg_target:
+        checks += planner.check_limits(target, sf_target.get_limits(), source_calls + target_calls,
+                                       sum(row['bulk_batches'] for row in rows),
+                                       sum(row['storage_mb'] for row in rows), budget)
+    else:
+        checks += planner.check_limits(source, sf_source.get_limits(), source_calls,
+                                       sum(row['source_bulk_batches'] for row in rows), None, budget)
+        checks += planner.check_limits(target, sf_target.get_limits(), target_calls,
+                                       sum(row['target_bulk_batches'] for row in rows),
+                                       sum(row['storage_mb'] for row in rows), budget)
+    plan = planner.summarize(tdm_config, rows, checks)
+    h.pool.close_all()
+    planner.write_plan(plan, path)
+
+    return plan
+
+
+# Run the delete and/or load steps of a single template row.
+def run_row(row, sf_cfg_source, sf_cfg_target, source, target, steps=('delete', 'load'), row_key=None):
+    row_start_time = h.dtm()
+    operation = row['operation']
+    obj = row['object']
+    thread = (row['bulk_thread'] if 'bulk_thread' in row else True)
+    primary_key = (row['primary_key'] if 'primary_key' in row else 'Id')
+    external_id = (row['external_id']
+                   if 'external_id' in row else 'UUID__c')
+    fields = list(row['fields'] if 'fields' in row else [])
+    where = (row['where'] if 'where' in row else '')
+    order_by = (row['order_by'] if 'order_by' in row else '')
+    limit = (row['limit'] if 'limit' in row else 0)
+    relationships = list(row['relationships']
+                         if 'relationships' in row else [])
+    masks = (row['masks'] if 'masks' in row else {})
+    stream = (row['stream'] if 'stream' in row else False)
+    extract_mode = (row['extract_mode']
+                    if 'extract_mode' in row else 'rest')
+    bulk_api = (row['bulk_api'] if 'bulk_api' in row else None)
+    mask_workers = (row['mask_workers'] if 'mask_workers' in row else None)
+    watermark_field = (row['watermark_field']
+                       if 'watermark_field' in row else 'SystemModstamp')
+    propagate_deletes = (row['propagate_deletes']
+                         if 'propagate_deletes' in row else False)
+    hard_delete = (row['hard_delete'] if 'hard_delete' in row else False)
+
+    log.info(f'{obj} {operation} {"/".join(steps)} -- {source}>>{target} started...')
+    # Continue if future operations are specified.
+    if operation in ['delete', 'execute']:
         log.info(
-            f'{operation} -- {source}>>{target} -- {obj} completed - run time: {row_end_time-row_start_time}')
+            f'{operation} is a future operation.  Not currently supported.')
+        return
+    # Skip steps a resumed run already completed.
+    if JOURNAL is not None and row_key:
+        completed = [step for step in steps
+                     if JOURNAL.is_done(f'{row_key}.{step}')]
+        if completed:
+            log.info(
+                f'{obj} {"/".join(completed)} already completed in run {JOURNAL.run_id}.')
+            steps = [step for step in steps if step not in completed]
+    checkpoint = (row_key if JOURNAL is not None else None)
+    # Perform delete portion of refresh operation and deleteAll operation.
+    if 'delete' in steps and operation in ['refresh', 'deleteAll']:
+        do_delete(sf_cfg_target=sf_cfg_target,
+                  object_name=obj,
+                  primary_key=primary_key,
+                  extract_mode=(row['extract_mode']
+                                if 'extract_mode' in row else 'auto'),
+                  hard_delete=hard_delete,
+                  thread=thread,
+                  bulk_api=bulk_api)
+        if checkpoint:
+            JOURNAL.mark_done(f'{checkpoint}.delete')
+    # Perform upsert portion of refresh operation and insert operation.
+    if 'load' in steps and operation in ['refresh', 'upsert', 'incremental']:
+        # Only extract records changed since the last incremental load.
+        if operation == 'incremental':
+            watermark = WATERMARKS.get(source, target, obj)
+            next_watermark = get_watermark(
+                sf_cfg_source, obj, watermark_field, where)
+            log.info(
+                f'{obj} incremental load from {watermark_field} {watermark} to {next_watermark}.')
+            where = incremental_where(where, watermark_field, watermark)
+        # Split relationships into two lists: self and other.
+        self_relationships = [relationship for relationship in relationships
+                              if relationship['object'] == obj]
+        relationships = [relationship for relationship in relationships
+                         if relationship['object'] != obj]
+        self_fields = [relationship['field']
+                       for relationship in self_relationships]
+        fields = [field for field in fields if field not in self_fields]
+        log.debug(f'Self relationships: {self_relationships}')
+        log.debug(f'Other relationships: {relationships}')
+        log.debug(f'fields after removing self_relationships: {fields}')
+        # Upsert without self-relationships.
+        n_success, n_error = do_upsert(sf_cfg_source=sf_cfg_source,
+                                       sf_cfg_target=sf_cfg_target,
+                                       relationships=relationships,
+                                       external_id=external_id,
+                                       object_name=obj,
+                                       fields=fields,
+                                       where=where,
+                                       order_by=order_by,
+                                       limit=limit,
+                                       masks=masks,
+                                       thread=thread,
+                                       stream=stream,
+                                       extract_mode=extract_mode,
+                                       bulk_api=bulk_api,
+                                       mask_workers=mask_workers,
+                                       checkpoint=(f'{checkpoint}.load' if checkpoint else None))
+        # Upsert self relationships.
+        if len(self_relationships) > 0:
+            _flds, _where = get_self_reln_fields_where(
+                where, self_relationships, external_id)
+            _n_success, _n_error = do_upsert(sf_cfg_source=sf_cfg_source,
+                                             sf_cfg_target=sf_cfg_target,
+                                             relationships=self_relationships,
+                                             external_id=external_id,
+                                             object_name=obj,
+                                             fields=_flds,
+                                             where=_where,
+                                             order_by=order_by,
+                                             limit=limit,
+                                             masks=masks,
+                                             thread=thread,
+                                             stream=stream,
+                                             extract_mode=extract_mode,
+                                             bulk_api=bulk_api,
+                                             mask_workers=mask_workers,
+                                             checkpoint=(f'{checkpoint}.load_self' if checkpoint else None))
+            n_error += _n_error
+        if operation == 'incremental':
+            if propagate_deletes and watermark:
+                delete_source_deletes(sf_cfg_source=sf_cfg_source,
+                                      sf_cfg_target=sf_cfg_target,
+                                      object_name=obj,
+                                      external_id=external_id,
+                                      where=f'IsDeleted = true and {watermark_field} > {watermark}',
+                                      thread=thread,
+                                      bulk_api=bulk_api)
+            # Records that were not loaded must be extracted again next run.
+            if next_watermark and MAKE_CHANGES and n_error == 0:
+                WATERMARKS.set(source, target, obj, next_watermark)
+            elif next_watermark:
+                log.warning(f'{obj} watermark kept at {watermark}: {n_error} failures, '
+                            f'MAKE_CHANGES set to {MAKE_CHANGES}.')
+        if checkpoint:
+            JOURNAL.mark_done(f'{checkpoint}.load')
+        # Get record count of target object.
+        target_data = get_data(sf_cfg_target, obj, [
+                               f'count({primary_key}) Ct'])
+        log.debug(f'{obj} final count: {target_data}')
+    row_end_time = h.dtm()
+    log.info(
+        f'{operation} {"/".join(steps)} -- {source}>>{target} -- {obj} completed - run time: {row_end_time-row_start_time}')
 
-    return f'Completed {tdm_config} template run.'
+
+# Return the latest watermark_field value of the source records, or None.
+def get_watermark(sf_cfg_source, obj, watermark_field, where=''):
+    query = build_soql(obj, [watermark_field], where,
+                       f'{watermark_field} desc', 1)
+    records = h.pool.rest(sf_cfg_source).soql_query(query)
+
+    return (records[0][watermark_field] if records else None)
+
+
+# Return where restricted to records changed after watermark, if any.
+def incremental_where(where, watermark_field, watermark):
+    if not watermark:
+        return where
+    return ' and '.join(([f'({where})'] if where else []) + [f'{watermark_field} > {watermark}'])
+
+
+# Delete target records whose source records were deleted, matched by external_id.
+@h.exception(log)
+@h.timer(log)
+def delete_source_deletes(sf_cfg_source, sf_cfg_target, object_name, external_id, where, thread=True,
+                          bulk_api=None):
+    query = build_soql(object_name, [external_id], where)
+    deleted = [record[external_id]
+               for page in h.pool.rest(sf_cfg_source).soql_query_iter(query, query_all=True)
+               for record in page
+               if record[external_id]]
+    log.info(f'{object_name} has {len(deleted)} deleted source records.')
+
+    delete_data = []
+    # Look up target Ids 200 external ids at a time to keep the query short.
+    for chunk in h.chunk_records(deleted, 200):
+        in_list = ', '.join("'" + str(value).replace("'", "\\'") + "'"
+                            for value in chunk)
+        delete_data.extend(get_data(sf_cfg_target, object_name, ['Id'],
+                                    where=f'{external_id} in ({in_list})'))
+    if delete_data:
+        do_bulk_job(sf_cfg_target=sf_cfg_target,
+                    job_type='Delete',
+                    object_name=object_name,
+                    data=delete_data,
+                    thread=thread,
+                    bulk_api=bulk_api)
+
+    return f'delete_source_deletes completed.'
+
+
+# Delete all records of object_name in the target. Ids are streamed from a query
+# straight into delete batches, so they are never held in memory all at once.
+@h.exception(log)
+@h.timer(log)
+def do_delete(sf_cfg_target, object_name, primary_key='Id', extract_mode='auto', hard_delete=False, thread=True,
+              bulk_api=None):
+    query = build_soql(object_name, [primary_key])
+    pages = extract_pages(sf_cfg_target, object_name,
+                          query, extract_mode, phase='delete_extract', fields=[primary_key], ranged=True)
+    # Hard deletes skip the recycle bin and need the "Bulk API Hard Delete" permission.
+    do_bulk_job_stream(sf_cfg_target=sf_cfg_target,
+                       job_type=('HardDelete' if hard_delete else 'Delete'),
+                       object_name=object_name,
+                       pages=pages,
+                       thread=thread,
+                       bulk_api=bulk_api,
+                       columns=projection.Projection([primary_key]))
+
+    return f'do_delete completed.'
+
+
+# Run template rows concurrently in dependency order: first all deletes, children
+# before parents, then all loads, parents before children. Bulk threads and REST
+# load requests of all rows share a budget of `concurrency` slots.
+def run_rows_parallel(data, sf_cfg_source, sf_cfg_target, source, target, concurrency):
+    global BULK_SLOTS
+    BULK_SLOTS = threading.BoundedSemaphore(concurrency)
+    dependencies = scheduler.build_dependencies(data)
+    log.info(f'Row dependencies: {dependencies}')
+    try:
+        run_deletes(data, sf_cfg_source, sf_cfg_target,
+                    source, target, concurrency, dependencies)
+        scheduler.run_dag(dependencies,
+                          lambda i: run_row(data[i], sf_cfg_source, sf_cfg_target, source, target,
+                                            steps=('load',), row_key=f'{i}.{data[i]["object"]}'),
+                          max_workers=concurrency)
+    finally:
+        BULK_SLOTS = None
+
+
+# Run the delete steps of all rows in reverse dependency order: children before
+# parents, independent objects concurrently.
+def run_deletes(data, sf_cfg_source, sf_cfg_target, source, target, max_workers, dependencies=None):
+    dependencies = (dependencies or scheduler.build_dependencies(data))
+    scheduler.run_dag(scheduler.reverse_dependencies(dependencies),
+                      lambda i: run_row(data[i], sf_cfg_source, sf_cfg_target, source, target,
+                                        steps=('delete',), row_key=f'{i}.{data[i]["object"]}'),
+                      max_workers=max_workers)
+
+
+# Run a template into several targets from a single extraction. Each row is
+# extracted and masked once into the snapshot cache, then run into all targets
+# concurrently, each target through its own connection pools. A target that
+# fails is logged and skips its remaining rows; the other targets carry on.
+# Return {target: error} of the failed targets.
+def run_fanout(data, sf_cfg_source, sf_cfg_targets, source, delete_workers=1):
+    failed = {}
+    with ThreadPoolExecutor(max_workers=len(sf_cfg_targets)) as executor:
+        def _run(targets, func):
+            futures = {executor.submit(func, target): target for target in targets}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as target_err:
+                    log.exception(
+                        f'Target {futures[future]} failed: {target_err}. Skipping its remaining rows.')
+                    failed[futures[future]] = str(target_err)
+
+        # Run all deletes up front, independent objects in parallel.
+        if delete_workers > 1:
+            _run(list(sf_cfg_targets),
+                 lambda target: run_deletes(data, sf_cfg_source, sf_cfg_targets[target], source, target,
+                                            delete_workers))
+        steps = (('load',) if delete_workers > 1 else ('delete', 'load'))
+        for i, row in enumerate(data):
+            targets = [target for target in sf_cfg_targets if target not in failed]
+            if not targets:
+                break
+            row_keys = {target: (f'{target}.{i}.{row["object"]}') for target in targets}
+            prime_snapshots(row, sf_cfg_source, source, targets, list(row_keys.values()))
+            _run(targets,
+                 lambda target: run_row(row, sf_cfg_source, sf_cfg_targets[target], source, target,
+                                        steps=steps, row_key=row_keys[target]))
+
+    return failed
+
+
+# Extract and mask the load data of a row for all targets into the snapshot
+# cache, once per distinct extraction (incremental targets can differ by watermark).
+def prime_snapshots(row, sf_cfg_source, source, targets, row_keys):
+    if JOURNAL is not None and all(JOURNAL.is_done(f'{row_key}.load') for row_key in row_keys):
+        return
+    extractions = {}
+    for target in targets:
+        for extraction in load_extractions(row, source, target):
+            key = get_snapshot_key(sf_cfg_source, **{name: extraction[name] for name in
+                                                     ['obj', 'fields', 'where', 'order_by', 'limit', 'masks']})
+            extractions[key] = extraction
+    for key, extraction in extractions.items():
+        if SNAPSHOTS.read(key) is None:
+            for _ in get_data_iter(sf_cfg_source, snapshot=True, ranged=True, **extraction):
+                pass
+
+
+# Return the get_data_iter arguments of a row's load into target, as run_row
+# and do_upsert extract them: the main pass and the self relationship pass.
+def load_extractions(row, source, target):
+    if row['operation'] not in ['refresh', 'upsert', 'incremental']:
+        return []
+    obj = row['object']
+    external_id = (row['external_id'] if 'external_id' in row else 'UUID__c')
+    fields = list(row['fields'] if 'fields' in row else [])
+    where = (row['where'] if 'where' in row else '')
+    relationships = list(row['relationships'] if 'relationships' in row else [])
+    if row['operation'] == 'incremental':
+        watermark_field = (row['watermark_field'] if 'watermark_field' in row else 'SystemModstamp')
+        where = incremental_where(where, watermark_field, WATERMARKS.get(source, target, obj))
+    self_relationships = [relationship for relationship in relationships
+                          if relationship['object'] == obj]
+    relationships = [relationship for relationship in relationships
+                     if relationship['object'] != obj]
+    self_fields = [relationship['field'] for relationship in self_relationships]
+    fields = replace_field_external_ids(relationships, [field for field in fields if field not in self_fields])
+    extraction = dict(obj=obj,
+                      order_by=(row['order_by'] if 'order_by' in row else ''),
+                      limit=(row['limit'] if 'limit' in row else 0),
+                      masks=(row['masks'] if 'masks' in row else {}),
+                      extract_mode=(row['extract_mode'] if 'extract_mode' in row else 'rest'),
+                      mask_workers=(row['mask_workers'] if 'mask_workers' in row else None))
+    extractions = [dict(extraction, fields=fields, where=where)]
+    if self_relationships:
+        _flds, _where = get_self_reln_fields_where(where, self_relationships, external_id)
+        extractions.append(dict(extraction, fields=_flds, where=_where))
+    return extractions
 
 
 # Functions
@@ -134,34 +622,7 @@ def replace_field_external_ids(relationships, fields, separator='.'):
 
 
 def replace_item_in_list(source, target, _list):
-    if source == target:
-        return _list
-    for fld in _list:
-        if fld == source:
-            _list.append(target)
-            _list.remove(source)
-
-    return _list
-
-
-def fix_flattened_fields(relationships, fields, data):
-    log.debug(f'Fields before fix_flattened_fields: {fields}')
-    for rel in relationships:
-        fields.append(f'{rel["relationship_name"]}_{rel["external_id"]}')
-
-    for rec in data:
-        {rec.pop(key) for key in list(rec.keys())
-         if key not in fields}
-
-        for rel in relationships:
-            reln_underscore_reference = f'{rel["relationship_name"]}_{rel["external_id"]}'
-            reln_dot_reference = f'{rel["relationship_name"]}.{rel["external_id"]}'
-            if reln_underscore_reference in rec:
-                rec[f'{rel["relationship_name"]}.{rel["external_id"]}'] = rec.pop(
-                    reln_underscore_reference)
-            if reln_dot_reference not in rec:
-                rec.update({reln_dot_reference: None})
-    return data
+    return [target if fld == source else fld for fld in _list]
 
 
 @h.exception(log)
@@ -176,34 +637,75 @@ def do_upsert(sf_cfg_source,
               order_by='',
               limit=0,
               masks='',
-              thread=True):
+              thread=True,
+              stream=False,
+              extract_mode='rest',
+              bulk_api=None,
+              mask_workers=None,
+              checkpoint=None):
+    # Load columns, with relationships rewritten to their external_id references.
+    upsert_columns = projection.upsert_projection(fields, relationships)
     # Replace field with relationship.external_id reference.
     if len(relationships) > 0:
         fields = replace_field_external_ids(relationships, fields)
         log.debug(
             f'Fields after replacing relationships with external_ids: {fields}')
+    # Checkpointed runs spill the extracted pages to the run journal, or read
+    # them back from there when resuming. A run-local fan-out cache already
+    # keeps them for the run, so its targets do not spill a copy each.
+    pages = None
+    if stream or checkpoint:
+        pages = get_data_iter(sf_cfg_source=sf_cfg_source,
+                              obj=object_name,
+                              fields=fields,
+                              where=where,
+                              order_by=order_by,
+                              limit=limit,
+                              masks=masks,
+                              extract_mode=extract_mode,
+                              mask_workers=mask_workers,
+                              snapshot=True,
+                              ranged=True)
+        if checkpoint and not SNAPSHOT_SPILLS:
+            pages = JOURNAL.spill(checkpoint, pages)
+    # Stream pages from source through masking and flattening into bulk batches.
+    if stream:
+        return do_bulk_job_stream(sf_cfg_target=sf_cfg_target,
+                                  job_type='Upsert',
+                                  object_name=object_name,
+                                  pages=pages,
+                                  primary_key=external_id,
+                                  thread=thread,
+                                  bulk_api=bulk_api,
+                                  checkpoint=checkpoint,
+                                  columns=upsert_columns)
     # Get data from source to upsert to target.
-    source_data = get_data(sf_cfg_source=sf_cfg_source,
-                           obj=object_name,
-                           fields=fields,
-                           where=where,
-                           order_by=order_by,
-                           limit=limit,
-                           masks=masks)
-    # Flatten and remove extraneous fields.
-    if len(relationships) > 0:
-        source_data = [h.flatten_dict(record) for record in source_data]
-        source_data = fix_flattened_fields(relationships, fields, source_data)
+    if pages is not None:
+        source_data = [record for page in pages for record in page]
+    else:
+        source_data = get_data(sf_cfg_source=sf_cfg_source,
+                               obj=object_name,
+                               fields=fields,
+                               where=where,
+                               order_by=order_by,
+                               limit=limit,
+                               masks=masks,
+                               extract_mode=extract_mode,
+                               mask_workers=mask_workers,
+                               snapshot=True,
+                               ranged=True)
     # Upsert source data into target.
-    if source_data:
-        do_bulk_job(sf_cfg_target=sf_cfg_target,
-                    job_type='Upsert',
-                    object_name=object_name,
-                    data=source_data,
-                    primary_key=external_id,
-                    thread=thread)
-
-    return f'do_upsert completed.'
+    if not source_data:
+        return 0, 0
+    return do_bulk_job(sf_cfg_target=sf_cfg_target,
+                       job_type='Upsert',
+                       object_name=object_name,
+                       data=source_data,
+                       primary_key=external_id,
+                       thread=thread,
+                       bulk_api=bulk_api,
+                       checkpoint=checkpoint,
+                       columns=upsert_columns)
 
 
 def get_self_reln_fields_where(where, relationships, external_id):
@@ -218,14 +720,23 @@ def get_self_reln_fields_where(where, relationships, external_id):
 
 @h.exception(log)
 @h.timer(log)
-def get_data(sf_cfg_source, obj, fields, where='', order_by='', limit=0, masks={}):
+def get_data(sf_cfg_source, obj, fields, where='', order_by='', limit=0, masks={}, extract_mode='rest',
+             mask_workers=None, snapshot=False, ranged=False):
+    if snapshot and SNAPSHOTS is not None:
+        records = [record
+                   for page in get_data_iter(sf_cfg_source, obj, fields, where, order_by, limit, masks,
+                                             extract_mode, mask_workers, snapshot, ranged)
+                   for record in page]
+        log.info(f'get_data result count: {len(records)}.')
+        return records
     query = build_soql(obj, fields, where, order_by, limit)
     _masks = masks
 
     soql_start_time = h.dtm()
-    sf_rest = h.get_sf_rest_connection(sf_cfg_source)
-    records = sf_rest.soql_query(query)
-    sf_rest.close_connection()
+    records = [record
+               for page in extract_pages(sf_cfg_source, obj, query, extract_mode, where, order_by, limit,
+                                         fields=fields, ranged=ranged)
+               for record in page]
     soql_end_time = h.dtm()
     log.info(
         f'get_data result count: {len(records)} - run time: {soql_end_time-soql_start_time}.')
@@ -233,9 +744,15 @@ def get_data(sf_cfg_source, obj, fields, where='', order_by='', limit=0, masks={
     if _masks:
         mask_start_time = h.dtm()
         log.debug('get_data apply masks start.')
-        for record in records:
-            for field, fake_method in _masks.items():
-                record.update({field: str(h.get_fake(fake_method))})
+        mask_workers = (MASK_WORKERS if mask_workers is None else mask_workers)
+        with METRICS.timer(obj, 'mask', records=len(records)):
+            if mask_workers > 1:
+                records = [record
+                           for chunk in masking.mask_parallel(h.chunk_records(records, MASK_CHUNK_SIZE), _masks,
+                                                              MASK_SEED, mask_workers)
+                           for record in chunk]
+            else:
+                apply_masks(records, _masks)
         mask_end_time = h.dtm()
         log.info(
             f'get_data apply masks completed - run time: {mask_end_time-mask_start_time}.')
@@ -243,6 +760,83 @@ def get_data(sf_cfg_source, obj, fields, where='', order_by='', limit=0, masks={
     return records
 
 
+# Yield source records page by page, masked, without materializing the whole object.
+def get_data_iter(sf_cfg_source, obj, fields, where='', order_by='', limit=0, masks={}, extract_mode='rest',
+                  mask_workers=None, snapshot=False, ranged=False):
+    # Serve masked source records from the snapshot cache when possible.
+    snapshot = (snapshot and SNAPSHOTS is not None)
+    if snapshot:
+        snapshot_key = get_snapshot_key(sf_cfg_source, obj, fields, where, order_by, limit, masks)
+        pages = SNAPSHOTS.read(snapshot_key)
+        if pages is not None:
+            yield from METRICS.timed(pages, obj, 'snapshot')
+            return
+    query = build_soql(obj, fields, where, order_by, limit)
+    pages = extract_pages(sf_cfg_source, obj, query,
+                          extract_mode, where, order_by, limit, fields=fields, ranged=ranged)
+    mask_workers = (MASK_WORKERS if mask_workers is None else mask_workers)
+    if masks and mask_workers > 1:
+        # Fan pages out to worker processes; masked pages come back in order.
+        pages = masking.mask_parallel(pages, masks, MASK_SEED, mask_workers)
+    elif masks:
+        # Compile the masks once for all pages.
+        engine = masking.MaskingEngine(masks, seed=MASK_SEED)
+        pages = (apply_masks(page, engine) for page in pages)
+    if masks:
+        pages = METRICS.timed(pages, obj, 'mask')
+    if snapshot:
+        pages = SNAPSHOTS.write(snapshot_key, pages, org=get_org_name(sf_cfg_source), object=obj,
+                                fields=fields, where=where, order_by=order_by, limit=limit)
+    n_records = 0
+    for page in pages:
+        n_records += len(page)
+        yield page
+    log.info(f'get_data_iter result count: {n_records}.')
+
+
+# Return the snapshot cache key of a masked source extraction.
+def get_snapshot_key(sf_cfg_source, obj, fields, where='', order_by='', limit=0, masks={}):
+    return SNAPSHOTS.key(org=get_org_name(sf_cfg_source), object=obj, fields=fields, where=where,
+                         order_by=order_by, limit=limit, masks=masks, mask_seed=MASK_SEED)
+
+
+# Return a page iterator for query using the REST API or a Bulk API query job.
+# extract_mode "auto" picks bulk when a count() pre-query reaches BULK_EXTRACT_THRESHOLD.
+# With REST_WORKERS > 1, ranged REST extractions (the load and delete extractions
+# of a row, never aggregate queries) of REST_RANGE_THRESHOLD or more records and
+# no limit are split into REST_RANGE_FIELD ranges fetched concurrently.
+def extract_pages(sf_cfg_source, obj, query, extract_mode='rest', where='', order_by='', limit=0,
+                  phase='extract', fields=None, ranged=False):
+    ranged = (ranged and REST_WORKERS > 1 and fields and not limit)
+    count = None
+    if extract_mode == 'auto' or (extract_mode == 'rest' and ranged):
+        with METRICS.timer(obj, 'count'):
+            count = h.pool.rest(sf_cfg_source).soql_count(
+                build_soql(obj, ['count()'], where))
+        count = (min(count, limit) if limit > 0 else count)
+    if extract_mode == 'auto':
+        extract_mode = ('bulk' if count >= BULK_EXTRACT_THRESHOLD else 'rest')
+        log.info(f'{obj} has {count} records, extracting with {extract_mode}.')
+    if extract_mode == 'bulk':
+        # PK chunking does not support order by or limit clauses.
+        return METRICS.timed(h.pool.bulk(sf_cfg_source).query_iter(obj, query, pk_chunking=not (order_by or limit)),
+                             obj, phase)
+    if ranged and count >= REST_RANGE_THRESHOLD:
+        return METRICS.timed(h.pool.rest(sf_cfg_source).soql_query_ranges(obj, ', '.join(fields), where, order_by,
+                                                                           workers=REST_WORKERS,
+                                                                           range_field=REST_RANGE_FIELD),
+                             obj, phase)
+
+    return METRICS.timed(h.pool.rest(sf_cfg_source).soql_query_iter(query), obj, phase)
+
+
+def apply_masks(records, masks):
+    if not isinstance(masks, masking.MaskingEngine):
+        masks = masking.MaskingEngine(masks, seed=MASK_SEED)
+
+    return masks.apply(records)
+
+
 def build_soql(sobject, fields, where='', order_by='', limit=0):
     select = 'select ' + ', '.join(fields)
     _from = f' from {sobject}'
@@ -258,64 +852,233 @@ def build_soql(sobject, fields, where='', order_by='', limit=0):
 
 @h.exception(log)
 @h.timer(log)
-def do_bulk_job(sf_cfg_target, job_type, object_name, data, thread=True, primary_key=''):
-    # Split records into batches by thread count.
-    # min_batch based on Salesforce processing details.
-    min_batch = 200
-    thread_count = (10 if job_type == 'Delete' else 20)
-    thread_count = (thread_count if thread else 1)
-    chunk_size = len(data) // thread_count
-    chunk_size = min_batch - (chunk_size % min_batch) + chunk_size
-    chunk_size = (5000 if chunk_size > 5000 else chunk_size)
-    log.debug(f'chunk_size: {chunk_size}')
-
-    batches = h.chunk_records(data, chunk_size)
-
-    with ThreadPoolExecutor(max_workers=thread_count) as executor:
-        futures = [executor.submit(do_bulk_job_thread, sf_cfg_target, job_type,
-                                   object_name, batch, primary_key) for batch in batches]
+def do_bulk_job(sf_cfg_target, job_type, object_name, data, thread=True, primary_key='', bulk_api=None,
+                checkpoint=None, columns=None):
+    # Small loads skip the bulk job overhead.
+    if use_rest_load(job_type, bulk_api, len(data)):
+        return run_rest_load(sf_cfg_target, job_type, object_name,
+                             (columns.records(data) if columns is not None else data), primary_key, thread)
+    # Split records into batches; size and thread count are learned per object by TUNER.
+    chunk_size, thread_count = TUNER.settings(
+        get_org_name(sf_cfg_target), object_name, job_type, len(data), thread)
+    # A resumed run must cut the same batches as the original one.
+    if checkpoint:
+        chunk_size = JOURNAL.chunk_size(checkpoint, chunk_size)
+    log.debug(f'chunk_size: {chunk_size}, thread_count: {thread_count}')
+
+    # Records are encoded one chunk at a time as the batches are cut.
+    batches = (cut_batches(h.chunk_records(data, chunk_size), chunk_size, columns, object_name)
+               if columns is not None else h.chunk_records(data, chunk_size))
+    return run_bulk_batches(sf_cfg_target, job_type, object_name, batches,
+                            thread_count, primary_key, bulk_api, chunk_size, checkpoint)
+
+
+@h.exception(log)
+@h.timer(log)
+def do_bulk_job_stream(sf_cfg_target, job_type, object_name, pages, thread=True, primary_key='',
+                       chunk_size=None, bulk_api=None, checkpoint=None, columns=None):
+    # Same as do_bulk_job, but batches are cut from a stream of record pages as they fill.
+    if use_rest_load(job_type, bulk_api):
+        records, pages = peek_records(pages, REST_LOAD_THRESHOLD)
+        if records is not None:
+            return run_rest_load(sf_cfg_target, job_type, object_name,
+                                 (columns.records(records) if columns is not None else records), primary_key,
+                                 thread)
+    _chunk_size, thread_count = TUNER.settings(
+        get_org_name(sf_cfg_target), object_name, job_type, None, thread)
+    chunk_size = (chunk_size or _chunk_size)
+    if checkpoint:
+        chunk_size = JOURNAL.chunk_size(checkpoint, chunk_size)
+    log.debug(f'chunk_size: {chunk_size}, thread_count: {thread_count}')
+
+    batches = cut_batches(pages, chunk_size, columns, object_name)
+    return run_bulk_batches(sf_cfg_target, job_type, object_name, batches,
+                            thread_count, primary_key, bulk_api, chunk_size, checkpoint)
+
+
+# Cut pages of records into batches of chunk_size records. With columns (a
+# projection.Projection) records are encoded straight into CSV batches, which
+# are also cut at the bulk batch size limit. Pages are encoded as the batches
+# are cut, so at most one page is held in encoded form.
+def cut_batches(pages, chunk_size, columns=None, object_name=''):
+    if columns is None:
+        return h.chunk_pages(pages, chunk_size)
+    encoded = (list(bulk_csv.encode_rows(columns.rows(page))) for page in pages)
+    encoded = METRICS.timed(encoded, object_name, 'flatten')
+    lines = (line for page in encoded for line in page)
+    return bulk_csv.csv_batches(bulk_csv.encode_header(columns.columns), lines, chunk_size)
+
+
+# Whether a load of n_records (None when not known yet) goes through REST sObject
+# Collections: below REST_LOAD_THRESHOLD, for the operations it supports, unless
+# the row asks for a specific bulk API.
+def use_rest_load(job_type, bulk_api=None, n_records=None):
+    return (REST_LOAD_THRESHOLD > 0 and bulk_api is None
+            and job_type in sf_rest_api.COLLECTION_JOB_TYPES
+            and (n_records is None or n_records <= REST_LOAD_THRESHOLD))
+
+
+# Read pages until more than max_records records have arrived. Return (records, None)
+# when the stream ended within max_records, else (None, pages) with the stream intact.
+def peek_records(pages, max_records):
+    pages = iter(pages)
+    head = []
+    n_records = 0
+    for page in pages:
+        head.append(page)
+        n_records += len(page)
+        if n_records > max_records:
+            return None, itertools.chain(head, pages)
+    return [record for page in head for record in page], None
 
+
+# Load records (flat dictionaries) through REST sObject Collections, requests
+# sent concurrently over the target's pooled session; in parallel runs each
+# request takes one of the BULK_SLOTS. Rows that failed on record locks are
+# retried once, one request at a time.
+def run_rest_load(sf_cfg_target, job_type, object_name, records, primary_key='', thread=True):
     n_success = 0
     n_error = 0
-    for future in as_completed(futures):
-        _n_success, _n_error = future.result()
-        n_success += _n_success
-        n_error += _n_error
-        log.info(
-            f'do_bulk_job_thread {job_type} completed with {_n_success} successes and {_n_error} failures.')
+    # Bypass if global is set to False.
+    if not MAKE_CHANGES:
+        log.debug(
+            f'MAKE_CHANGES set to {MAKE_CHANGES}, skipping REST {job_type} of {len(records)} {object_name} records.')
+        return n_success, n_error
+
+    phase = job_type.lower()
+    with METRICS.context(object_name, phase):
+        sf_rest = h.pool.rest(sf_cfg_target)
+        start_time = time.perf_counter()
+        errors = {}
+        locked_rows = []
+        # Rows with bulk_thread false load one request at a time, like their bulk jobs.
+        workers = (REST_LOAD_WORKERS if thread else 1)
+        for rows, results in sf_rest.load_collection(job_type, object_name, records, primary_key,
+                                                     workers, BULK_SLOTS):
+            _n_success, _n_error = count_results(results, errors)
+            n_success += _n_success
+            n_error += _n_error
+            if _n_error and tuning.LOCK_ERROR in errors:
+                locked_rows.extend(row for row, result in zip(rows, results)
+                                   if result.success != 'true' and tuning.classify_error(result.error) == tuning.LOCK_ERROR)
+        METRICS.add(object_name, phase, seconds=time.perf_counter() - start_time,
+                    records=n_success + n_error)
+        METRICS.errors(object_name, errors)
+
+        if locked_rows:
+            log.info(
+                f'Retrying {len(locked_rows)} {object_name} {job_type} records that failed with {tuning.LOCK_ERROR}.')
+            METRICS.add(object_name, phase, retries=len(locked_rows))
+            for rows, results in sf_rest.load_collection(job_type, object_name, locked_rows, primary_key, 1,
+                                                         BULK_SLOTS):
+                _n_success, _n_error = count_results(results)
+                n_success += _n_success
+                n_error -= _n_success
     log.info(
-        f'do_bulk_job {object_name} {job_type} completed with {n_success} successes and {n_error} failures.')
+        f'REST {object_name} {job_type} completed with {n_success} successes and {n_error} failures.')
 
-    return f'do_bulk_job completed.'
+    return n_success, n_error
 
 
-@h.exception(log)
-@h.timer(log)
-def do_bulk_job_thread(sf_cfg_target, job_type, object_name, data, primary_key):
-    log.debug(
-        f'do_bulk_job_thread {job_type} on {object_name} - batch size: {len(data)}')
+def run_bulk_batches(sf_cfg_target, job_type, object_name, batches, thread_count, primary_key='', bulk_api=None,
+                     chunk_size=None, checkpoint=None):
     n_success = 0
     n_error = 0
-    # with open(f'./output/bulk{h.timestamp()}.json', 'w') as json_file:
-    #     json.dump(data, json_file)
+    # Skip batches that succeeded before a resume and remember the index of the others.
+    batch_index = {}
+    if checkpoint:
+        done = JOURNAL.done_batches(checkpoint)
+        batches = pending_batches(batches, done, batch_index)
     # Bypass if global is set to False.
-    if MAKE_CHANGES:
-        if job_type == 'Delete':
-            batch_results = h.get_sf_bulk_connection(sf_cfg_target).create_and_run_delete_job(
-                object_name=object_name, data=data)
-        else:
-            batch_results = h.get_sf_bulk_connection(sf_cfg_target).create_and_run_bulk_job(
-                job_type=job_type,
-                object_name=object_name,
-                primary_key=primary_key,
-                data=data)
-    else:
+    if not MAKE_CHANGES:
         log.debug(f'MAKE_CHANGES set to {MAKE_CHANGES}')
-        batch_results = []
+        for batch in batches:
+            log.debug(
+                f'run_bulk_batches {job_type} on {object_name} - batch size: {len(batch)}')
+        return n_success, n_error
+
+    # API calls of the job are attributed to its phase, e.g. "upsert".
+    phase = job_type.lower()
+    with METRICS.context(object_name, phase):
+        sf_bulk = h.pool.bulk(sf_cfg_target, bulk_api)
+        # Update batches of this job share one freshly built Id index.
+        if job_type == 'Update':
+            sf_bulk.clear_id_index(object_name)
+        # All batches go into one job; open batches count against the global
+        # concurrency budget when rows run in parallel.
+        job_start_time = time.perf_counter()
+        job_results = sf_bulk.run_bulk_job(job_type=job_type,
+                                           object_name=object_name,
+                                           batches=batches,
+                                           primary_key=primary_key,
+                                           concurrency=(
+                                               'Parallel' if thread_count > 1 else 'Serial'),
+                                           max_open=thread_count,
+                                           slots=BULK_SLOTS)
+        errors = {}
+        locked_rows = []
+        for rows, batch_results in job_results:
+            _n_success, _n_error = count_results(batch_results, errors)
+            n_success += _n_success
+            n_error += _n_error
+            index = batch_index.pop(id(rows), None)
+            if checkpoint and index is not None and _n_error == 0:
+                JOURNAL.mark_batch(checkpoint, index)
+            if _n_error and tuning.LOCK_ERROR in errors:
+                locked_rows.extend(row for row, result in zip(rows, batch_results)
+                                   if result.success != 'true' and tuning.classify_error(result.error) == tuning.LOCK_ERROR)
+            log.info(
+                f'{object_name} {job_type} batch of {len(rows)} completed with {_n_success} successes and {_n_error} failures.')
+        job_seconds = time.perf_counter() - job_start_time
+        METRICS.add(object_name, phase, seconds=job_seconds,
+                    records=n_success + n_error)
+        METRICS.errors(object_name, errors)
+        if chunk_size:
+            TUNER.record(get_org_name(sf_cfg_target), object_name, job_type, chunk_size, thread_count,
+                         n_success + n_error, job_seconds, errors)
+
+        # Retry rows that failed on record locks one batch at a time.
+        if locked_rows:
+            log.info(
+                f'Retrying {len(locked_rows)} {object_name} {job_type} records that failed with {tuning.LOCK_ERROR}.')
+            METRICS.add(object_name, phase, retries=len(locked_rows))
+            retry_results = sf_bulk.run_bulk_job(job_type=job_type,
+                                                 object_name=object_name,
+                                                 batches=h.chunk_records(
+                                                     locked_rows, chunk_size or tuning.DEFAULT_MAX_BATCH),
+                                                 primary_key=primary_key,
+                                                 concurrency='Serial',
+                                                 max_open=1,
+                                                 slots=BULK_SLOTS)
+            for rows, batch_results in retry_results:
+                _n_success, _n_error = count_results(batch_results)
+                n_success += _n_success
+                n_error -= _n_success
+    log.info(
+        f'do_bulk_job {object_name} {job_type} completed with {n_success} successes and {n_error} failures.')
+
+    return n_success, n_error
+
+
+def pending_batches(batches, done, batch_index):
+    for i, batch in enumerate(batches):
+        if i in done:
+            log.debug(f'Skipping batch {i}, completed before resume.')
+            continue
+        batch_index[id(batch)] = i
+        yield batch
 
+
+def count_results(batch_results, errors=None):
+    n_success = 0
+    n_error = 0
     for result in batch_results:
         if result.success != 'true':
             n_error += 1
+            if errors is not None:
+                error_class = tuning.classify_error(result.error)
+                errors[error_class] = (errors[error_class] + 1
+                                       if error_class in errors else 1)
             log.warning(
                 f'Record Failed in batch: {result.error}.')
         else:
@@ -324,6 +1087,37 @@ def do_bulk_job_thread(sf_cfg_target, job_type, object_name, data, primary_key):
     return n_success, n_error
 
 
+# Return {row_key: fields} of the template rows whose load fields, or
+# relationship external ids, the target does not have. Objects are described
+# concurrently through the describe cache.
+def get_missing_fields(data, sf_cfg_target, workers=10):
+    rows = [(i, row) for i, row in enumerate(data)
+            if row['operation'] in ['refresh', 'upsert', 'incremental']]
+    objects = ([row['object'] for i, row in rows]
+               + [rel['object'] for i, row in rows
+                  for rel in (row['relationships'] if 'relationships' in row else [])])
+    describes = h.pool.rest(sf_cfg_target).describe_objects(objects, workers)
+    # Salesforce field names are case insensitive.
+    names = {obj: {field['name'].lower() for field in describe['fields']}
+             for obj, describe in describes.items()}
+    missing = {}
+    for i, row in rows:
+        obj = row['object']
+        _missing = [field for field in (row['fields'] if 'fields' in row else [])
+                    if '.' not in field and field.lower() not in names[obj]]
+        _missing += [f'{rel["relationship_name"]}.{rel["external_id"]}'
+                     for rel in (row['relationships'] if 'relationships' in row else [])
+                     if rel['external_id'].lower() not in names[rel['object']]]
+        if _missing:
+            missing[f'{i}.{obj}'] = _missing
+    return missing
+
+
+# Name of an org config file without path and extension, e.g. "prs.dev".
+def get_org_name(sf_cfg):
+    return os.path.splitext(os.path.basename(sf_cfg))[0]
+
+
 # Run main program
 if __name__ == '__main__':
     h.setup_logging()
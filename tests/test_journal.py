@@ -0,0 +1,32 @@
+from tools import journal
+
+
+# Source pages of one record each, in extraction order or reversed.
+def spill_source(n_pages, reverse=False):
+    for i in (reversed(range(n_pages)) if reverse else range(n_pages)):
+        yield [{'Id': str(i)}]
+
+
+def test_resume_keeps_batches_of_a_complete_spill(tmp_path):
+    run = journal.RunJournal('run', path=str(tmp_path))
+    spilled = list(run.spill('0.Account.load', spill_source(3)))
+    run.mark_batch('0.Account.load', 0)
+
+    resumed = journal.RunJournal('run', path=str(tmp_path))
+    assert list(resumed.spill('0.Account.load', spill_source(3, reverse=True))) == spilled
+    assert resumed.done_batches('0.Account.load') == {0}
+
+
+def test_resume_resends_batches_of_an_incomplete_spill(tmp_path):
+    run = journal.RunJournal('run', path=str(tmp_path))
+    stream = run.spill('0.Account.load', spill_source(3))
+    next(stream)
+    run.mark_batch('0.Account.load', 0)
+    # The run dies mid-stream.
+    stream.close()
+
+    resumed = journal.RunJournal('run', path=str(tmp_path))
+    resumed_pages = list(resumed.spill('0.Account.load', spill_source(3, reverse=True)))
+    assert resumed_pages[0] == [{'Id': '2'}]
+    assert resumed.done_batches('0.Account.load') == set()
+    assert journal.RunJournal('run', path=str(tmp_path)).done_batches('0.Account.load') == set()
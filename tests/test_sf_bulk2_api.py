@@ -0,0 +1,164 @@
+import csv
+import io
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from tools import sf_bulk2_api
+from tools.bulk_csv import CsvBatch, encode_header
+
+API_VERSION = '58.0'
+INGEST_PATH = f'/services/data/v{API_VERSION}/jobs/ingest'
+
+
+# Fake Bulk API 2.0 ingest endpoint. Jobs report InProgress on their first poll.
+# Uploaded records named "bad..." fail, "skip..." are left unprocessed and the
+# others succeed; each result file lists its records in reverse upload order,
+# so the client has to rebuild rows from the result files to keep them aligned.
+class FakeBulk2Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=b'', content_type='application/json'):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode('utf-8')
+        elif isinstance(body, str):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def _job(self):
+        match = re.match(rf'{INGEST_PATH}/(\w+)/', self.path)
+        return (self.server.jobs.get(match.group(1)) if match else None)
+
+    def do_POST(self):
+        if self.path.rstrip('/') != INGEST_PATH:
+            return self._send(404)
+        payload = json.loads(self._body())
+        job_id = f'750{len(self.server.jobs):015d}'
+        self.server.jobs[job_id] = {'id': job_id, 'payload': payload, 'state': 'Open',
+                                    'csv': None, 'polls': 0}
+        self._send(200, {'id': job_id, 'state': 'Open', **payload})
+
+    def do_PUT(self):
+        job = self._job()
+        if job is None or not self.path.endswith('/batches') or job['state'] != 'Open':
+            return self._send(404)
+        job['content_type'] = self.headers.get('Content-Type')
+        job['csv'] = self._body().decode('utf-8')
+        self._send(201)
+
+    def do_PATCH(self):
+        job = self._job()
+        if job is None or job['csv'] is None:
+            return self._send(400)
+        job['state'] = json.loads(self._body())['state']
+        self._send(200, {'id': job['id'], 'state': job['state']})
+
+    def do_GET(self):
+        job = self._job()
+        if job is None:
+            return self._send(404)
+        if self.path == f'{INGEST_PATH}/{job["id"]}/':
+            job['polls'] += 1
+            state = ('InProgress' if job['polls'] == 1 else 'JobComplete')
+            rows = list(csv.DictReader(io.StringIO(job['csv'])))
+            return self._send(200, {'id': job['id'], 'state': state,
+                                    'numberRecordsProcessed': len(rows),
+                                    'numberRecordsFailed': sum(row['Name'].startswith('bad') for row in rows)})
+        rows = list(reversed(list(csv.DictReader(io.StringIO(job['csv'])))))
+        if self.path.endswith('/successfulResults/'):
+            rows = [{'sf__Id': f'001{row["Name"]}', 'sf__Created': 'true', **row}
+                    for row in rows if not row['Name'].startswith(('bad', 'skip'))]
+        elif self.path.endswith('/failedResults/'):
+            rows = [{'sf__Id': '', 'sf__Error': f'REQUIRED_FIELD_MISSING:{row["Name"]}', **row}
+                    for row in rows if row['Name'].startswith('bad')]
+        elif self.path.endswith('/unprocessedrecords/'):
+            rows = [row for row in rows if row['Name'].startswith('skip')]
+        else:
+            return self._send(404)
+        buffer = io.StringIO()
+        fieldnames = (list(rows[0].keys()) if rows else ['sf__Id'])
+        writer = csv.DictWriter(buffer, fieldnames=fieldnames, lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(rows)
+        self._send(200, buffer.getvalue(), 'text/csv')
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), FakeBulk2Handler)
+    httpd.jobs = {}
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def connection(server):
+    return sf_bulk2_api.Connection('SESSION', f'http://127.0.0.1:{server.server_address[1]}', API_VERSION)
+
+
+def check_alignment(rows, results):
+    assert len(rows) == len(results)
+    for row, result in zip(rows, results):
+        if row['Name'].startswith('bad'):
+            assert (result.success, result.error) == ('false', f'REQUIRED_FIELD_MISSING:{row["Name"]}')
+        elif row['Name'].startswith('skip'):
+            assert (result.id, result.success) == (None, 'false')
+        else:
+            assert (result.id, result.success, result.created) == (f'001{row["Name"]}', 'true', 'true')
+
+
+def test_upsert_job_rows_align_with_results(server):
+    records = [{'Name': name, 'Ext__c': f'E{i}'}
+               for i, name in enumerate(['ok1', 'bad1', 'ok2', 'skip1', 'ok3', 'bad2'])]
+    jobs = list(connection(server).run_bulk_job('upsert', 'Account', [records[:3], records[3:]],
+                                                primary_key='Ext__c', min_poll=0.01))
+
+    assert len(jobs) == 1
+    job = next(iter(server.jobs.values()))
+    assert job['payload'] == {'object': 'Account', 'operation': 'upsert', 'contentType': 'CSV',
+                              'lineEnding': 'LF', 'externalIdFieldName': 'Ext__c'}
+    assert job['content_type'] == 'text/csv'
+    assert job['csv'].splitlines()[0] == 'Name,Ext__c'
+    assert job['state'] == 'UploadComplete'
+    assert job['polls'] >= 2
+    rows, results = jobs[0]
+    assert sorted(row['Name'] for row in rows) == sorted(record['Name'] for record in records)
+    check_alignment(rows, results)
+    assert sum(result.success == 'true' for result in results) == 3
+
+
+def test_csv_batches_upload_one_job_each_when_over_upload_size(server, monkeypatch):
+    header = encode_header(['Name'])
+    batches = [CsvBatch(header, b'ok1\nbad1\n', 2), CsvBatch(header, b'skip1\nok2\n', 2)]
+    monkeypatch.setattr(sf_bulk2_api, 'MAX_UPLOAD_BYTES', len(header) + 12)
+    jobs = list(connection(server).run_bulk_job('insert', 'Contact', batches, min_poll=0.01))
+
+    assert len(jobs) == 2
+    assert sorted(job['csv'] for job in server.jobs.values()) == ['Name\nok1\nbad1\n', 'Name\nskip1\nok2\n']
+    for rows, results in jobs:
+        check_alignment(rows, results)
+
+
+def test_finished_jobs_release_their_slots(server, monkeypatch):
+    header = encode_header(['Name'])
+    batches = [CsvBatch(header, b'ok1\nbad1\n', 2), CsvBatch(header, b'skip1\nok2\n', 2)]
+    monkeypatch.setattr(sf_bulk2_api, 'MAX_UPLOAD_BYTES', len(header) + 12)
+    slots = threading.BoundedSemaphore(3)
+    jobs = list(connection(server).run_bulk_job('insert', 'Contact', batches, max_open=1, slots=slots,
+                                                min_poll=0.01))
+
+    assert len(jobs) == 2
+    assert all(slots.acquire(blocking=False) for _ in range(3))
@@ -0,0 +1,74 @@
+import logging
+import threading
+import time
+
+from tools import sf_rest_api
+
+
+def range_connection(n_pages, barrier):
+    # Connection with a single range boundary (3 ranges) whose ranges each
+    # wait for all the others before their last page.
+    connection = object.__new__(sf_rest_api.Connection)
+    connection.log = logging.getLogger(__name__)
+    connection._range_bounds = lambda object_name, range_field, where, workers: ['2020-01-01']
+    queries = []
+
+    def soql_query_iter(query):
+        queries.append(query)
+        for i in range(n_pages):
+            if i == n_pages - 1:
+                barrier.wait()
+            yield [{'Id': f'{query}-{i}', 'CreatedDate': None}]
+
+    connection.soql_query_iter = soql_query_iter
+    return connection, queries
+
+
+def test_unordered_ranges_are_fetched_concurrently():
+    barrier = threading.Barrier(3, timeout=5)
+    connection, queries = range_connection(5, barrier)
+    pages = list(connection.soql_query_ranges('Account', 'Id, CreatedDate', workers=2))
+    assert len(queries) == 3
+    assert sorted(page[0]['Id'] for page in pages) == sorted(
+        f'{query}-{i}' for query in queries for i in range(5))
+    assert not barrier.broken
+
+
+def test_ordered_ranges_are_merged():
+    connection = object.__new__(sf_rest_api.Connection)
+    connection.log = logging.getLogger(__name__)
+    connection._range_bounds = lambda object_name, range_field, where, workers: ['2020-01-01']
+    names = iter([['b', 'e'], ['a', 'd'], ['c', 'f']])
+    ranges = {}
+
+    def soql_query_iter(query):
+        ranges.setdefault(query, next(names))
+        yield [{'Name': name} for name in ranges[query]]
+
+    connection.soql_query_iter = soql_query_iter
+    pages = list(connection.soql_query_ranges('Account', 'Name', order_by='Name', workers=2, page_size=4))
+    assert [[record['Name'] for record in page] for page in pages] == [['a', 'b', 'c', 'd'], ['e', 'f']]
+
+
+def test_collection_requests_take_shared_slots():
+    connection = object.__new__(sf_rest_api.Connection)
+    slots = threading.BoundedSemaphore(2)
+    lock = threading.Lock()
+    in_flight = [0, 0]
+
+    def collection_request(job_type, object_name, rows, primary_key):
+        with lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight)
+        time.sleep(0.05)
+        with lock:
+            in_flight[0] -= 1
+        return [sf_rest_api.CollectionResult(None, 'true', 'true', '') for _ in rows]
+
+    connection._collection_request = collection_request
+    records = [{'Name': str(i)} for i in range(sf_rest_api.COLLECTION_SIZE * 6)]
+    loaded = list(connection.load_collection('Insert', 'Account', records, workers=4, slots=slots))
+
+    assert sum(len(rows) for rows, results in loaded) == len(records)
+    assert in_flight[1] == 2
+    assert all(slots.acquire(blocking=False) for _ in range(2))
@@ -5,6 +5,7 @@ __author__ = 'Stephen Stokes: sstokes[at]relationshipvelocity.com'
 
 # Imports
 import tools.helpers as h
+from tools import masking
 
 
 # Code
@@ -21,3 +22,10 @@ for x in range(1000):
     str(h.get_fake(method))
 fn = h.dtm()
 print(f'{method}: {fn-st}')
+
+records = [{'EIN__c': str(x)} for x in range(1000)]
+for seed in [None, 1]:
+    st = h.dtm()
+    masking.MaskingEngine({'EIN__c': 'fake.ein'}, seed=seed).apply(records)
+    fn = h.dtm()
+    print(f'MaskingEngine fake.ein seed={seed}: {fn-st}')
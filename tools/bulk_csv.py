@@ -0,0 +1,76 @@
+__author__ = 'Stephen Stokes: sstokes[at]relationshipvelocity.com'
+
+import csv
+import io
+
+# Bulk API 1.0 batch limits.
+MAX_BATCH_ROWS = 10000
+MAX_BATCH_BYTES = 10 * 1000 * 1000
+
+
+# A bulk batch of pre-encoded CSV: the header line and the record lines as
+# bytes, posted as is. Iterating decodes the records back into dictionaries,
+# which is only needed for failed rows and Update Id lookups.
+class CsvBatch(object):
+    __slots__ = ('header', 'body', 'n_rows')
+
+    def __init__(self, header, body, n_rows):
+        self.header = header
+        self.body = body
+        self.n_rows = n_rows
+
+    @property
+    def data(self):
+        return self.header + self.body
+
+    def __len__(self):
+        return self.n_rows
+
+    def __bool__(self):
+        return self.n_rows > 0
+
+    def __iter__(self):
+        return iter(csv.DictReader(io.StringIO(bytes(self.data).decode('utf-8'))))
+
+
+# Encode each row (a sequence of values) as one CSV line of bytes, None becoming an empty value.
+def encode_rows(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate(0)
+
+
+# Return a list of dictionaries as a CsvBatch, with the keys of the first row as columns.
+def dicts_batch(rows):
+    columns = list(rows[0].keys())
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns,
+                            lineterminator='\n', extrasaction='ignore')
+    writer.writerows(rows)
+    return CsvBatch(encode_header(columns), buffer.getvalue().encode('utf-8'), len(rows))
+
+
+# Return the CSV header line of columns as bytes.
+def encode_header(columns):
+    return next(encode_rows([columns]))
+
+
+# Cut a stream of encoded CSV lines into CsvBatches of at most max_rows rows and
+# max_bytes bytes, including the header.
+def csv_batches(header, lines, max_rows=MAX_BATCH_ROWS, max_bytes=MAX_BATCH_BYTES):
+    chunk = []
+    size = len(header)
+    for line in lines:
+        if chunk and (len(chunk) >= max_rows or size + len(line) > max_bytes):
+            yield CsvBatch(header, b''.join(chunk), len(chunk))
+            chunk = []
+            size = len(header)
+        chunk.append(line)
+        size += len(line)
+    if chunk:
+        yield CsvBatch(header, b''.join(chunk), len(chunk))
+
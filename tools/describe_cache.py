@@ -0,0 +1,92 @@
+__author__ = 'Stephen Stokes: sstokes[at]relationshipvelocity.com'
+
+import gzip
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+# On-disk cache of sObject describes per org, revalidated with the ETag and
+# Last-Modified headers of the cached copy (a 304 response carries no body).
+# Each describe is a gzip compressed JSON file, ./cache/describe/<org>/<sobject>.json.gz.
+# Describes revalidated once are served from memory for the rest of the
+# process, or from disk without revalidation while younger than max_age_hours.
+class DescribeCache(object):
+    def __init__(self, path='./cache/describe', max_age_hours=0):
+        self.path = path
+        self.max_age = max_age_hours * 3600
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._validated = set()
+
+    # Return the cached entry of sobject: {"describe", "etag", "last_modified", "fetched"}, or None.
+    def get(self, org, sobject):
+        key = (org, sobject)
+        with self._lock:
+            if key in self._entries:
+                return self._entries[key]
+        file_path = self._file(org, sobject)
+        if not os.path.exists(file_path):
+            return None
+        try:
+            with gzip.open(file_path, 'rt', encoding='utf-8') as describe_file:
+                entry = json.load(describe_file)
+        except (OSError, ValueError) as cache_err:
+            log.warning(f'Ignoring cached describe of {org} {sobject}: {cache_err}')
+            return None
+        with self._lock:
+            self._entries[key] = entry
+        return entry
+
+    # Whether the cached describe can be used without revalidation.
+    def is_fresh(self, org, sobject):
+        with self._lock:
+            if (org, sobject) in self._validated:
+                return True
+            entry = (self._entries[(org, sobject)] if (org, sobject) in self._entries else None)
+        return (entry is not None and self.max_age > 0 and time.time() - entry['fetched'] < self.max_age)
+
+    # Conditional request headers revalidating the cached describe.
+    def headers(self, org, sobject):
+        entry = self.get(org, sobject)
+        headers = {}
+        if entry and entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    # Mark the cached describe as still current (a 304 response).
+    def touch(self, org, sobject):
+        with self._lock:
+            self._validated.add((org, sobject))
+            entry = self._entries[(org, sobject)]
+            entry['fetched'] = time.time()
+        self._save(org, sobject, entry)
+
+    def put(self, org, sobject, describe, etag=None, last_modified=None):
+        entry = {'describe': describe, 'etag': etag, 'last_modified': last_modified, 'fetched': time.time()}
+        with self._lock:
+            self._entries[(org, sobject)] = entry
+            self._validated.add((org, sobject))
+        self._save(org, sobject, entry)
+
+    def _file(self, org, sobject):
+        return os.path.join(self.path, re.sub(r'[^\w.-]', '_', org), f'{sobject}.json.gz')
+
+    def _save(self, org, sobject, entry):
+        file_path = self._file(org, sobject)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        tmp_path = f'{file_path}.{threading.get_ident()}.tmp'
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as describe_file:
+            json.dump(entry, describe_file)
+        os.replace(tmp_path, file_path)
+
+
+# Describe cache shared by all connections.
+DESCRIBES = DescribeCache()
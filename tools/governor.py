@@ -0,0 +1,173 @@
+__author__ = 'Stephen Stokes: sstokes[at]relationshipvelocity.com'
+
+import logging
+import random
+import re
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests as r
+
+from tools import metrics
+
+log = logging.getLogger(__name__)
+
+# HTTP statuses worth retrying: rate limited, unavailable and gateway errors.
+TRANSIENT_STATUS = [429, 502, 503, 504]
+# Org-wide concurrency limits clear by themselves; TotalRequests is the daily cap and does not.
+TRANSIENT_ERRORS = ['REQUEST_LIMIT_EXCEEDED', 'ConcurrentPerOrgLongTxn', 'SERVER_UNAVAILABLE']
+LIMIT_INFO = re.compile(r'api-usage=(\d+)/(\d+)')
+
+
+class ApiBudgetExceeded(RuntimeError):
+    pass
+
+
+# Return the key of the org an URL belongs to, its host name.
+def org_key(url):
+    return (urlparse(url).netloc or url or '').lower()
+
+
+# Rate governor shared by all connections. Keeps the daily API requests and bulk
+# batches of each org under `budget` (a share of the org's daily limits, read
+# from the /limits endpoint and the Sforce-Limit-Info response header), and
+# retries transient failures with jittered exponential backoff.
+class RateGovernor(object):
+    def __init__(self, budget=0.9, max_retries=5, base_delay=1.0, max_delay=60.0, refresh_seconds=300):
+        self.budget = budget
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.refresh_seconds = refresh_seconds
+        self._lock = threading.Lock()
+        self._orgs = {}
+
+    def _org(self, org):
+        if org not in self._orgs:
+            self._orgs[org] = {'api_used': 0, 'api_max': None, 'batches_used': 0, 'batches_max': None,
+                               'loader': None, 'refreshed': 0}
+        return self._orgs[org]
+
+    # Register the function returning the /limits JSON of an org.
+    def register(self, org, loader):
+        with self._lock:
+            self._org(org)['loader'] = loader
+
+    # Update usage from a /limits response.
+    def update_limits(self, org, limits):
+        with self._lock:
+            state = self._org(org)
+            if 'DailyApiRequests' in limits:
+                state['api_max'] = limits['DailyApiRequests']['Max']
+                state['api_used'] = state['api_max'] - limits['DailyApiRequests']['Remaining']
+            if 'DailyBulkApiBatches' in limits:
+                state['batches_max'] = limits['DailyBulkApiBatches']['Max']
+                state['batches_used'] = state['batches_max'] - limits['DailyBulkApiBatches']['Remaining']
+        log.debug(f'{org} limits: {self.usage(org)}')
+
+    # Update API usage from a Sforce-Limit-Info header, e.g. "api-usage=25/15000".
+    def update_header(self, org, header):
+        match = LIMIT_INFO.search(header or '')
+        if match:
+            with self._lock:
+                state = self._org(org)
+                state['api_used'] = int(match.group(1))
+                state['api_max'] = int(match.group(2))
+
+    def usage(self, org):
+        with self._lock:
+            state = self._org(org)
+            return {key: state[key] for key in ['api_used', 'api_max', 'batches_used', 'batches_max']}
+
+    # Count calls made to an org between limit updates.
+    def count(self, org, api_calls=1, batches=0):
+        with self._lock:
+            state = self._org(org)
+            state['api_used'] += api_calls
+            state['batches_used'] += batches
+
+    # Raise ApiBudgetExceeded when the org's usage has reached the budget.
+    def check(self, org):
+        self._refresh(org)
+        with self._lock:
+            state = self._org(org)
+            for used, limit, name in [('api_used', 'api_max', 'daily API requests'),
+                                      ('batches_used', 'batches_max', 'daily Bulk API batches')]:
+                if state[limit] and state[used] >= state[limit] * self.budget:
+                    raise ApiBudgetExceeded(
+                        f'{org} used {state[used]} of {state[limit]} {name}, over the budget of {self.budget:.0%}.')
+
+    def _refresh(self, org):
+        with self._lock:
+            state = self._org(org)
+            loader = state['loader']
+            if loader is None or time.time() - state['refreshed'] < self.refresh_seconds:
+                return
+            # Mark first: the loader's own request passes through check.
+            state['refreshed'] = time.time()
+        try:
+            self.update_limits(org, loader())
+        except Exception as limits_err:
+            log.warning(f'Could not read {org} limits: {limits_err}')
+
+    # Send an HTTP request (a function returning a requests.Response), retrying transient failures.
+    def send(self, org, request):
+        for attempt in range(self.max_retries + 1):
+            self.check(org)
+            try:
+                response = request()
+            except (r.ConnectionError, r.Timeout) as conn_err:
+                if attempt == self.max_retries:
+                    raise
+                self._backoff(org, attempt, conn_err)
+                continue
+            self.count(org)
+            self.update_header(org, response.headers.get('Sforce-Limit-Info'))
+            if not self._transient_response(response) or attempt == self.max_retries:
+                return response
+            self._backoff(org, attempt, f'HTTP {response.status_code}',
+                          response.headers.get('Retry-After'))
+        return response
+
+    # Run func, retrying exceptions is_transient accepts (by default connection errors).
+    def call(self, org, func, is_transient=None, batches=0):
+        for attempt in range(self.max_retries + 1):
+            self.check(org)
+            try:
+                result = func()
+                self.count(org, batches=batches)
+                return result
+            except Exception as call_err:
+                transient = (isinstance(call_err, (r.ConnectionError, r.Timeout))
+                             or (is_transient is not None and is_transient(call_err)))
+                if not transient or attempt == self.max_retries:
+                    raise
+                self._backoff(org, attempt, call_err)
+
+    def _transient_response(self, response):
+        if response.status_code in TRANSIENT_STATUS:
+            return True
+        return (response.status_code == 403 and is_transient_message(response.text))
+
+    def _backoff(self, org, attempt, reason, retry_after=None):
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        # Full jitter spreads out the retries of parallel threads.
+        delay = random.uniform(delay / 2, delay)
+        if retry_after and str(retry_after).isdigit():
+            delay = max(delay, int(retry_after))
+        metrics.METRICS.retry()
+        log.warning(f'{org} request failed ({reason}), retry {attempt + 1} of {self.max_retries} '
+                    f'in {delay:.1f} seconds.')
+        time.sleep(delay)
+
+
+# Whether an error message is a limit or outage that clears by itself.
+def is_transient_message(message):
+    message = str(message)
+    return (any(error in message for error in TRANSIENT_ERRORS)
+            and 'TotalRequests' not in message)
+
+
+# Rate governor of the current run, shared by all connections.
+GOVERNOR = RateGovernor()
@@ -7,12 +7,13 @@ import functools
 import json
 import logging.config
 import os
+import threading
 import time
 from datetime import datetime
 
 from faker import Faker
 
-from tools import sf_bulk_api, sf_rest_api
+from tools import masking, sf_bulk2_api, sf_bulk_api, sf_rest_api
 
 # Variables
 fake = Faker()
@@ -45,26 +46,10 @@ def get_config(config_file):
 
 # Get fake value based on method
 def get_fake(method):
-    if method[:5] == 'fixed':
-        mask = {
-            "fixed.company": "Acme Dynamite, Inc.",
-            "fixed.date_of_birth": "1970-01-01",
-            "fixed.ein": "95-8101756",
-            "fixed.email": "joel19@gmail.com",
-            "fixed.name": "Valerie Duke",
-            "fixed.ssn": "247-03-5127"
-        }
-    else:
-        mask = {
-            "fake.company": fake.company(),
-            "fake.date_of_birth": fake.date_of_birth(minimum_age=21, maximum_age=115),
-            "fake.ein": fake.ein(),
-            "fake.email": fake.email(),
-            "fake.name": fake.name(),
-            "fake.ssn": fake.ssn()
-        }
+    if method in masking.FIXED_VALUES:
+        return masking.FIXED_VALUES[method]
 
-    return mask[method]
+    return masking.fake_generators(fake)[method]()
 
 
 # Get reference to sf_rest_api module
@@ -77,7 +62,8 @@ def get_sf_rest_connection(config):
         grant_type=_config['sf_grant_type'],
         client_id=_config['sf_client_id'],
         client_secret=_config['sf_client_secret'],
-        sandbox=_config['sf_sandbox'])
+        sandbox=_config['sf_sandbox'],
+        pool_size=(_config['sf_pool_size'] if 'sf_pool_size' in _config else 10))
 
     return sf_rest
 
@@ -95,6 +81,63 @@ def get_sf_bulk_connection(config):
     return sf_bulk
 
 
+# Per-org cache of authenticated connections, shared by all threads of a run.
+class ConnectionPool(object):
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._rest = {}
+        self._bulk = {}
+
+    # Return the sf_rest_api connection for config, logging in on first use.
+    def rest(self, config):
+        key = os.path.abspath(config)
+        with self._lock:
+            if key not in self._rest:
+                self._rest[key] = get_sf_rest_connection(config)
+            return self._rest[key]
+
+    # Return the bulk connection for config, sharing the REST access token.
+    # api is "1.0" (sf_bulk_api) or "2.0" (sf_bulk2_api); defaults to the org
+    # config's "sf_bulk_api" setting, then "1.0".
+    def bulk(self, config, api=None):
+        key = os.path.abspath(config)
+        with self._lock:
+            if api is None:
+                _config = get_config(config)
+                api = (_config['sf_bulk_api']
+                       if 'sf_bulk_api' in _config else '1.0')
+            if (key, api) not in self._bulk:
+                sf_rest = self.rest(config)
+                if api == '2.0':
+                    sf_bulk = sf_bulk2_api.Connection(
+                        session_id=sf_rest.access_token,
+                        instance_url=sf_rest.instance_url,
+                        api_version=sf_rest.api_version,
+                        reauth=sf_rest.refresh_session,
+                        query_connection=self.bulk(config, '1.0'))
+                else:
+                    sf_bulk = sf_bulk_api.Connection(
+                        session_id=sf_rest.access_token,
+                        instance_url=sf_rest.instance_url,
+                        api_version=sf_rest.api_version,
+                        reauth=sf_rest.refresh_session)
+                self._bulk[(key, api)] = sf_bulk
+            return self._bulk[(key, api)]
+
+    def close_all(self):
+        with self._lock:
+            for sf_rest in self._rest.values():
+                sf_rest.close_connection()
+            for sf_bulk in self._bulk.values():
+                if hasattr(sf_bulk, 'close_connection'):
+                    sf_bulk.close_connection()
+            self._rest.clear()
+            self._bulk.clear()
+
+
+pool = ConnectionPool()
+
+
 # Conversion of nested dictionary into flattened dictionary
 def flatten_dict(dd, separator='_', prefix=''):
     return {prefix + separator + k if prefix else k: v
@@ -109,6 +152,18 @@ def chunk_records(records, chunk_size):
         yield records[step:step+chunk_size]
 
 
+# Regroup a stream of record pages into chunks of chunk_size records
+def chunk_pages(pages, chunk_size):
+    chunk = []
+    for page in pages:
+        chunk.extend(page)
+        while len(chunk) >= chunk_size:
+            yield chunk[:chunk_size]
+            chunk = chunk[chunk_size:]
+    if chunk:
+        yield chunk
+
+
 # Return formatted timestamp or datestamp
 def timestamp():
     return datetime.now().strftime('%H:%M:%S.%f')
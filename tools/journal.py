@@ -0,0 +1,101 @@
+__author__ = 'Stephen Stokes: sstokes[at]relationshipvelocity.com'
+
+import json
+import logging
+import os
+import shutil
+import threading
+
+from tools import helpers as h
+from tools.snapshot import SnapshotCache
+
+log = logging.getLogger(__name__)
+
+
+# Journal of a template run, used to resume it after a failure. Completed row
+# steps and successful bulk batches are appended to runs/<run_id>/journal.jsonl;
+# extracted source data is spilled to runs/<run_id>/spill so a resumed run
+# re-submits exactly the same batches.
+class RunJournal(object):
+    def __init__(self, run_id=None, path='./runs'):
+        self.run_id = (run_id or h.dtm().strftime('%Y%m%d-%H%M%S'))
+        self.path = os.path.join(path, self.run_id)
+        self._journal_path = os.path.join(self.path, 'journal.jsonl')
+        self._lock = threading.Lock()
+        self._steps = set()
+        self._batches = {}
+        self._chunk_sizes = {}
+        os.makedirs(self.path, exist_ok=True)
+        if os.path.exists(self._journal_path):
+            with open(self._journal_path, 'r') as journal_file:
+                for line in journal_file:
+                    self._apply(json.loads(line))
+            log.info(
+                f'Resuming run {self.run_id}: {len(self._steps)} steps completed.')
+        # Never expire spilled data while the run can still be resumed.
+        self.spills = SnapshotCache(path=os.path.join(self.path, 'spill'),
+                                    ttl_hours=24 * 365, max_mb=1024 * 1024)
+
+    # Run settings (template, target, options) saved at the start of a run.
+    def save_settings(self, **settings):
+        with open(os.path.join(self.path, 'run.json'), 'w') as json_file:
+            json.dump(settings, json_file, indent=2)
+
+    def get_settings(self):
+        return h.get_config(os.path.join(self.path, 'run.json'))
+
+    def is_done(self, step):
+        return step in self._steps
+
+    def mark_done(self, step):
+        self._append({'step': step})
+
+    def done_batches(self, job):
+        return set(self._batches[job] if job in self._batches else [])
+
+    def mark_batch(self, job, index):
+        self._append({'job': job, 'batch': index})
+
+    # Return the chunk size first used for job, so resumed batches line up.
+    def chunk_size(self, job, chunk_size):
+        with self._lock:
+            if job in self._chunk_sizes:
+                return self._chunk_sizes[job]
+        self._append({'job': job, 'chunk_size': chunk_size})
+        return chunk_size
+
+    # Return spilled pages for name, or spill pages while passing them through.
+    # pages is not consumed when a complete spill already exists.
+    def spill(self, name, pages):
+        spilled = self.spills.read(name)
+        if spilled is not None:
+            pages.close()
+            return spilled
+        # Batches marked done were cut from a spill that never completed. A
+        # fresh extraction may return the records in another order, so all
+        # batches are sent again; upserts are idempotent.
+        if self.done_batches(name):
+            log.info(f'Spill of {name} is incomplete, resending all of its batches.')
+            self._append({'job': name, 'reset': True})
+        return self.spills.write(name, pages, object=name)
+
+    # Remove spilled data once the run has completed.
+    def close(self):
+        shutil.rmtree(os.path.join(self.path, 'spill'), ignore_errors=True)
+        log.info(f'Run {self.run_id} completed.')
+
+    def _append(self, event):
+        with self._lock:
+            self._apply(event)
+            with open(self._journal_path, 'a') as journal_file:
+                journal_file.write(json.dumps(event) + '\n')
+
+    def _apply(self, event):
+        if 'step' in event:
+            self._steps.add(event['step'])
+        elif 'batch' in event:
+            self._batches.setdefault(event['job'], []).append(event['batch'])
+        elif 'reset' in event:
+            self._batches.pop(event['job'], None)
+        elif 'chunk_size' in event:
+            self._chunk_sizes[event['job']] = event['chunk_size']
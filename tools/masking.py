@@ -0,0 +1,153 @@
+__author__ = 'Stephen Stokes: sstokes[at]relationshipvelocity.com'
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+from faker import Faker
+
+FIXED_VALUES = {
+    "fixed.company": "Acme Dynamite, Inc.",
+    "fixed.date_of_birth": "1970-01-01",
+    "fixed.ein": "95-8101756",
+    "fixed.email": "joel19@gmail.com",
+    "fixed.name": "Valerie Duke",
+    "fixed.ssn": "247-03-5127"
+}
+
+
+# Return the fake.* generators bound to a Faker instance.
+def fake_generators(faker):
+    return {
+        "fake.company": faker.company,
+        "fake.date_of_birth": lambda: faker.date_of_birth(minimum_age=21, maximum_age=115),
+        "fake.ein": faker.ein,
+        "fake.email": faker.email,
+        "fake.name": faker.name,
+        "fake.ssn": faker.ssn
+    }
+
+
+# Bounded, thread-safe least-recently-used mapping.
+class LRUCache(object):
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+# Source value -> fake value mappings shared by all engines of a run.
+MASK_CACHE = LRUCache()
+
+
+class MaskingEngine(object):
+    def __init__(self, masks, seed=None, cache=MASK_CACHE):
+        """
+        Compile a template "masks" spec ({field: method}) once into per-field generators.
+
+        :param masks: Field name to mask method, e.g. {"EIN__c": "fake.ein"}.
+        :type masks: dict
+        :param seed: When set, masking is deterministic: the fake value is generated from a hash of
+                     seed, method and source value, so a source value always maps to the same fake
+                     across objects and runs.
+        :type seed: int
+        :param cache: LRU cache of deterministic mappings.
+        :type cache: LRUCache
+        """
+        self.seed = seed
+        self.cache = cache
+        self.faker = Faker()
+        if seed is not None:
+            self.faker.seed_instance(seed)
+        generators = fake_generators(self.faker)
+        self.fields = []
+        for field, method in masks.items():
+            if method in FIXED_VALUES:
+                generator = (lambda value=FIXED_VALUES[method]: value)
+            elif method in generators:
+                generator = generators[method]
+            else:
+                raise ValueError(f'Unknown mask method "{method}" for {field}.')
+            self.fields.append((field, method, generator))
+        self._lock = threading.Lock()
+
+    # Mask records in place, one field at a time across the whole batch.
+    def apply(self, records):
+        for field, method, generator in self.fields:
+            if method in FIXED_VALUES:
+                value = generator()
+                for record in records:
+                    record[field] = value
+            elif self.seed is None:
+                with self._lock:
+                    values = [str(generator()) for _ in records]
+                for record, value in zip(records, values):
+                    record[field] = value
+            else:
+                for record in records:
+                    record[field] = self.mask_value(method, generator,
+                                                    record.get(field))
+        return records
+
+    # Deterministic fake for a source value, served from the LRU cache when possible.
+    def mask_value(self, method, generator, source_value):
+        key = (self.seed, method, source_value)
+        value = self.cache.get(key)
+        if value is None:
+            digest = hashlib.sha256(
+                f'{self.seed}|{method}|{source_value}'.encode('utf-8')).digest()
+            with self._lock:
+                self.faker.seed_instance(int.from_bytes(digest[:8], 'big'))
+                value = str(generator())
+            self.cache.put(key, value)
+        return value
+
+
+
+# Engine of a masking worker process, built once by _init_worker.
+_worker_engine = None
+
+
+def _init_worker(masks, seed):
+    global _worker_engine
+    _worker_engine = MaskingEngine(masks, seed=seed)
+    # Forked workers inherit the parent's random state; without a seed each
+    # worker needs its own, or every chunk would get the same fake values.
+    if seed is None:
+        _worker_engine.faker.seed_instance(int.from_bytes(os.urandom(8), 'big'))
+
+
+def _mask_chunk(records):
+    return _worker_engine.apply(records)
+
+
+# Mask chunks of records on a pool of worker processes and yield them in their original order.
+# Each worker compiles its own seeded engine, so deterministic masking gives the same output
+# regardless of which worker handles a chunk.
+def mask_parallel(chunks, masks, seed=None, workers=2):
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(masks, seed)) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(_mask_chunk, chunk))
+            # Keep a bounded number of chunks in flight.
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
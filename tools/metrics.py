@@ -0,0 +1,169 @@
+__author__ = 'Stephen Stokes: sstokes[at]relationshipvelocity.com'
+
+import csv
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+PHASE_FIELDS = ['seconds', 'records', 'bytes', 'api_calls', 'retries']
+
+
+# Per object and phase (count, extract, mask, flatten, delete, upsert, poll, ...)
+# durations, record counts, bytes transferred, API calls and retries of a run,
+# plus bulk failures by status code. API connections attribute their calls to
+# the object and phase of the calling thread's current context.
+class RunMetrics(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self._phases = {}
+            self._errors = {}
+
+    # Return the (object, phase) calls of this thread are attributed to.
+    def current(self):
+        return getattr(self._local, 'context', ('', 'other'))
+
+    @contextmanager
+    def context(self, object_name, phase):
+        previous = self.current()
+        self._local.context = (object_name, phase)
+        try:
+            yield
+        finally:
+            self._local.context = previous
+
+    # Time a block as phase of object_name; its API calls are attributed to it.
+    @contextmanager
+    def timer(self, object_name, phase, records=0):
+        start = time.perf_counter()
+        try:
+            with self.context(object_name, phase):
+                yield
+        finally:
+            self.add(object_name, phase, seconds=time.perf_counter() - start, records=records)
+
+    # Pass pages through, timing each step as phase of object_name. Time spent in
+    # timed stages upstream of this one (e.g. extraction under masking) is not
+    # counted twice.
+    def timed(self, pages, object_name, phase):
+        pages = iter(pages)
+        while True:
+            outer = getattr(self._local, 'nested', 0.0)
+            self._local.nested = 0.0
+            start = time.perf_counter()
+            try:
+                with self.context(object_name, phase):
+                    page = next(pages, None)
+            finally:
+                elapsed = time.perf_counter() - start
+                inner = self._local.nested
+                self._local.nested = outer + elapsed
+            self.add(object_name, phase, seconds=elapsed - inner,
+                     records=(len(page) if page is not None else 0))
+            if page is None:
+                return
+            yield page
+
+    def add(self, object_name, phase, seconds=0.0, records=0, n_bytes=0, api_calls=0, retries=0):
+        with self._lock:
+            key = (object_name or '', phase)
+            if key not in self._phases:
+                self._phases[key] = dict.fromkeys(PHASE_FIELDS, 0)
+            stat = self._phases[key]
+            stat['seconds'] += seconds
+            stat['records'] += records
+            stat['bytes'] += n_bytes
+            stat['api_calls'] += api_calls
+            stat['retries'] += retries
+
+    # Count an API call of the current context.
+    def api_call(self, n_bytes=0):
+        object_name, phase = self.current()
+        self.add(object_name, phase, n_bytes=n_bytes, api_calls=1)
+
+    def retry(self, n=1):
+        object_name, phase = self.current()
+        self.add(object_name, phase, retries=n)
+
+    # Add bulk failures of object_name by status code, e.g. {"UNABLE_TO_LOCK_ROW": 3}.
+    def errors(self, object_name, errors):
+        with self._lock:
+            counts = self._errors.setdefault(object_name, {})
+            for category, n in errors.items():
+                counts[category] = (counts[category] if category in counts else 0) + n
+
+    def report(self, run_id=None):
+        with self._lock:
+            phases = []
+            for (object_name, phase), stat in sorted(self._phases.items()):
+                row = dict(object=object_name, phase=phase, **stat)
+                row['seconds'] = round(stat['seconds'], 3)
+                row['records_per_sec'] = (round(stat['records'] / stat['seconds'], 1)
+                                          if stat['seconds'] > 0 else None)
+                phases.append(row)
+            errors = {object_name: dict(counts)
+                      for object_name, counts in self._errors.items()}
+        totals = {field: sum(row[field] for row in phases)
+                  for field in ['bytes', 'api_calls', 'retries']}
+        return {
+            'run_id': run_id,
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            'seconds': round(time.time() - self.started, 3),
+            'totals': totals,
+            'phases': phases,
+            'errors': errors
+        }
+
+    # Return the report in OpenMetrics text format.
+    def openmetrics(self, run_id=None):
+        report = self.report(run_id)
+        lines = []
+        for field in PHASE_FIELDS + ['records_per_sec']:
+            lines.append(f'# TYPE tdm_phase_{field} gauge')
+            for row in report['phases']:
+                if row[field] is not None:
+                    lines.append(f'tdm_phase_{field}{{object="{row["object"]}",phase="{row["phase"]}"}} '
+                                 f'{row[field]}')
+        lines.append('# TYPE tdm_bulk_errors gauge')
+        for object_name, counts in report['errors'].items():
+            for category, n in counts.items():
+                lines.append(f'tdm_bulk_errors{{object="{object_name}",category="{category}"}} {n}')
+        lines.append('# TYPE tdm_run_seconds gauge')
+        lines.append(f'tdm_run_seconds {report["seconds"]}')
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    # Write the run report as <path>/<name>.json and .csv, and .prom with openmetrics.
+    def write(self, path='./reports', name=None, openmetrics=False):
+        name = (name or time.strftime('%Y%m%d-%H%M%S'))
+        report = self.report(name)
+        os.makedirs(path, exist_ok=True)
+        base = os.path.join(path, name)
+        with open(base + '.json', 'w') as json_file:
+            json.dump(report, json_file, indent=2)
+        with open(base + '.csv', 'w', newline='') as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=['object', 'phase'] + PHASE_FIELDS + ['records_per_sec'])
+            writer.writeheader()
+            writer.writerows(report['phases'])
+        if openmetrics:
+            with open(base + '.prom', 'w') as prom_file:
+                prom_file.write(self.openmetrics(name))
+        for row in sorted(report['phases'], key=lambda row: -row['seconds'])[:10]:
+            log.info(f'{row["object"]} {row["phase"]}: {row["seconds"]}s, {row["records"]} records, '
+                     f'{row["api_calls"]} API calls.')
+        log.info(f'Run report written to {base}.json.')
+        return base + '.json'
+
+
+# Metrics of the current run, shared by all modules.
+METRICS = RunMetrics()
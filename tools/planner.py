@@ -0,0 +1,171 @@
+__author__ = 'Stephen Stokes: sstokes[at]relationshipvelocity.com'
+
+import glob
+import json
+import logging
+import math
+import os
+import time
+
+log = logging.getLogger(__name__)
+
+# Records per second assumed for phases without history, per phase.
+DEFAULT_RECORDS_PER_SEC = {'extract': 2000, 'delete_extract': 2000, 'upsert': 500, 'delete': 1000}
+# Records per REST query page and per PK chunked bulk query batch.
+REST_PAGE_SIZE = 2000
+BULK_QUERY_CHUNK = 100000
+# Records per REST sObject Collections request.
+COLLECTION_SIZE = 200
+# Average seconds between bulk batch status polls.
+POLL_SECONDS = 10
+# Data storage Salesforce counts for most records.
+RECORD_KB = 2
+
+
+# Return {(object, phase): records_per_sec} of previous run reports in path,
+# the most recent report of each object and phase winning.
+def report_throughput(path='./reports'):
+    throughput = {}
+    for report_path in sorted(glob.glob(os.path.join(path, '*.json')), key=os.path.getmtime):
+        try:
+            with open(report_path) as json_file:
+                report = json.load(json_file)
+        except (OSError, ValueError) as report_err:
+            log.warning(f'Skipping run report {report_path}: {report_err}')
+            continue
+        for row in (report['phases'] if 'phases' in report else []):
+            if row['records'] and row['records_per_sec']:
+                throughput[(row['object'], row['phase'])] = row['records_per_sec']
+    return throughput
+
+
+# Return the records per second of an object phase: learned by the tuner
+# (learned), else from previous run reports, else the default.
+def records_per_sec(throughput, object_name, phase, learned=None):
+    if learned:
+        return learned
+    if (object_name, phase) in throughput:
+        return throughput[(object_name, phase)]
+    return DEFAULT_RECORDS_PER_SEC[phase]
+
+
+# Return (api_calls, bulk_batches) of extracting n_records with a REST query or bulk query job.
+def extract_calls(n_records, extract_mode):
+    if extract_mode == 'bulk':
+        chunks = max(1, math.ceil(n_records / BULK_QUERY_CHUNK))
+        # Create, add batch, close and status, plus result list and download per chunk.
+        return 4 + 2 * chunks, chunks
+    return max(1, math.ceil(n_records / REST_PAGE_SIZE)), 0
+
+
+# Return (api_calls, bulk_batches) of a bulk job loading n_records in seconds,
+# or of REST sObject Collections requests with rest_load.
+def job_calls(n_records, chunk_size, seconds, rest_load=False):
+    if not n_records:
+        return 0, 0
+    if rest_load:
+        return math.ceil(n_records / COLLECTION_SIZE), 0
+    batches = math.ceil(n_records / chunk_size)
+    # Create and close the job, post and read the results of each batch, plus polls.
+    return 2 + 2 * batches + math.ceil(seconds / POLL_SECONDS), batches
+
+
+# Estimate of one template row: records, bulk batches, API calls per org and
+# seconds per phase. Phases of a streamed row overlap, so the total is an upper bound.
+def estimate_row(object_name, operation, n_load, n_delete, load_extract, delete_extract,
+                 load_chunk, delete_chunk, throughput, load_rate=None, delete_rate=None,
+                 load_rest=False, delete_rest=False):
+    seconds = {}
+    source_calls, source_batches = 0, 0
+    target_calls, target_batches = 0, 0
+    if n_delete is not None:
+        seconds['delete_extract'] = n_delete / records_per_sec(throughput, object_name, 'delete_extract')
+        seconds['delete'] = n_delete / records_per_sec(throughput, object_name, 'delete', delete_rate)
+        calls, batches = extract_calls(n_delete, delete_extract)
+        target_calls += calls
+        target_batches += batches
+        calls, batches = job_calls(n_delete, delete_chunk, seconds['delete'], delete_rest)
+        target_calls += calls
+        target_batches += batches
+    if n_load is not None:
+        seconds['extract'] = n_load / records_per_sec(throughput, object_name, 'extract')
+        seconds['upsert'] = n_load / records_per_sec(throughput, object_name, 'upsert', load_rate)
+        source_calls, source_batches = extract_calls(n_load, load_extract)
+        calls, batches = job_calls(n_load, load_chunk, seconds['upsert'], load_rest)
+        # One more call for the final target count.
+        target_calls += calls + 1
+        target_batches += batches
+    # Every loaded record may be new; a refresh deletes the old ones first.
+    storage_mb = ((n_load or 0) - (n_delete or 0)) * RECORD_KB / 1024
+    return {
+        'object': object_name,
+        'operation': operation,
+        'delete_records': n_delete,
+        'load_records': n_load,
+        'delete_extract': (delete_extract if n_delete is not None else None),
+        'load_extract': (load_extract if n_load is not None else None),
+        'source_api_calls': source_calls,
+        'target_api_calls': target_calls,
+        'bulk_batches': source_batches + target_batches,
+        'source_bulk_batches': source_batches,
+        'target_bulk_batches': target_batches,
+        'storage_mb': round(storage_mb, 1),
+        'seconds': {phase: round(value, 1) for phase, value in seconds.items()},
+        'total_seconds': round(sum(seconds.values()), 1)
+    }
+
+
+# Return whether needed API requests, bulk batches and storage fit an org's
+# remaining limits (a /limits response), keeping usage under budget. Storage is
+# only checked when storage_mb is given.
+def check_limits(org, limits, api_calls, bulk_batches, storage_mb=None, budget=0.9):
+    checks = []
+    for name, needed in [('DailyApiRequests', api_calls), ('DailyBulkApiBatches', bulk_batches),
+                         ('DataStorageMB', storage_mb)]:
+        if name not in limits or needed is None:
+            continue
+        limit = limits[name]
+        # Daily limits are governed to a share of the maximum; storage is not.
+        cap = (limit['Max'] if name == 'DataStorageMB' else limit['Max'] * budget)
+        available = cap - (limit['Max'] - limit['Remaining'])
+        checks.append({'org': org, 'limit': name, 'needed': round(needed, 1),
+                       'available': round(available, 1), 'fits': needed <= available})
+    return checks
+
+
+# Return the plan of a template from its row estimates and org limit checks.
+def summarize(template, rows, checks):
+    totals = {key: round(sum(row[key] for row in rows), 1)
+              for key in ['source_api_calls', 'target_api_calls', 'bulk_batches', 'storage_mb', 'total_seconds']}
+    totals['delete_records'] = sum(row['delete_records'] or 0 for row in rows)
+    totals['load_records'] = sum(row['load_records'] or 0 for row in rows)
+    return {
+        'template': template,
+        'planned': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'fits': all(check['fits'] for check in checks),
+        'totals': totals,
+        'limits': checks,
+        'rows': rows
+    }
+
+
+# Log the plan and write it to <path>/plan-<timestamp>.json.
+def write_plan(plan, path='./plans'):
+    for row in plan['rows']:
+        missing = (f', missing fields {row["missing_fields"]}' if row.get('missing_fields') else '')
+        log.info(f'{row["object"]} {row["operation"]}: delete {row["delete_records"]}, load {row["load_records"]} '
+                 f'records, {row["bulk_batches"]} bulk batches, '
+                 f'{row["source_api_calls"] + row["target_api_calls"]} API calls, ~{row["total_seconds"]}s{missing}.')
+    for check in plan['limits']:
+        log.log((logging.INFO if check['fits'] else logging.WARNING),
+                f'{check["org"]} {check["limit"]}: needs {check["needed"]} of {check["available"]} available.')
+    totals = plan['totals']
+    log.info(f'Plan: {totals["delete_records"]} records to delete, {totals["load_records"]} to load, '
+             f'{totals["bulk_batches"]} bulk batches, ~{totals["total_seconds"]}s; '
+             f'{"fits" if plan["fits"] else "does NOT fit"} the remaining org limits.')
+    os.makedirs(path, exist_ok=True)
+    plan_path = os.path.join(path, f'plan-{time.strftime("%Y%m%d-%H%M%S")}.json')
+    with open(plan_path, 'w') as json_file:
+        json.dump(plan, json_file, indent=2)
+    log.info(f'Plan written to {plan_path}.')
+    return plan_path
@@ -0,0 +1,53 @@
+__author__ = 'Stephen Stokes: sstokes[at]relationshipvelocity.com'
+
+
+# Return the value at a nested path, e.g. ('Parent', 'UUID__c'), or None when
+# a relationship along the way is empty.
+def get_path(record, path):
+    for key in path:
+        if record is None:
+            return None
+        record = record.get(key)
+    return record
+
+
+# Mapping of source records to the flat columns of a bulk load, compiled once
+# per object. Columns are field names; relationship columns such as
+# "Parent.UUID__c" are read from the nested relationship record returned by the
+# REST API and bulk queries. Each record is projected in a single pass, without
+# flattening the whole record first.
+class Projection(object):
+    def __init__(self, fields, separator='.'):
+        self.columns = tuple(dict.fromkeys(fields))
+        self._getters = tuple(self._getter(column.split(separator))
+                              for column in self.columns)
+
+    @staticmethod
+    def _getter(path):
+        if len(path) == 1:
+            return (lambda record, key=path[0]: record.get(key))
+        return (lambda record, path=tuple(path): get_path(record, path))
+
+    # Return records as CSV-ready tuples, in column order.
+    def rows(self, records):
+        getters = self._getters
+        return [tuple([getter(record) for getter in getters]) for record in records]
+
+    # Return records as flat dictionaries keyed by column.
+    def records(self, records):
+        pairs = tuple(zip(self.columns, self._getters))
+        return [{column: getter(record) for column, getter in pairs} for record in records]
+
+
+# Return the projection of a template row's fields for an upsert: every
+# relationship is rewritten to its relationship_name.external_id column and
+# other relationship fields are left out.
+def upsert_projection(fields, relationships, separator='.'):
+    references = {rel['field']: f'{rel["relationship_name"]}{separator}{rel["external_id"]}'
+                  for rel in relationships}
+    columns = [references[field] if field in references else field
+               for field in fields]
+    columns.extend(references.values())
+    columns = [column for column in columns
+               if separator not in column or column in references.values()]
+    return Projection(columns, separator)
@@ -0,0 +1,131 @@
+__author__ = 'Stephen Stokes: sstokes[at]relationshipvelocity.com'
+
+import json
+from collections.abc import Mapping, MutableMapping
+
+# orjson decodes query pages faster than json when installed. Its dictionaries
+# do not share keys between records, so it is only used for compact Rows.
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    orjson = None
+    _loads = json.loads
+
+
+# A query record stored as a tuple of values against a schema shared by all
+# records with the same fields ({field: index}), instead of a dictionary per
+# record. Behaves as a mutable mapping: the values become a list on the first
+# write, e.g. masking, and keys that are not in the schema, e.g. masked fields
+# that were not queried, go to a per-record dictionary.
+class Row(MutableMapping):
+    __slots__ = ('_schema', '_values', '_extra')
+
+    def __init__(self, schema, values):
+        self._schema = schema
+        self._values = values
+        self._extra = None
+
+    def __getitem__(self, key):
+        if key in self._schema:
+            return self._values[self._schema[key]]
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    # Faster than the Mapping mixin, which goes through __getitem__ and KeyError.
+    def get(self, key, default=None):
+        index = self._schema.get(key)
+        if index is not None:
+            return self._values[index]
+        if self._extra is not None:
+            return self._extra.get(key, default)
+        return default
+
+    def __setitem__(self, key, value):
+        if key in self._schema:
+            if type(self._values) is tuple:
+                self._values = list(self._values)
+            self._values[self._schema[key]] = value
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self._schema:
+            raise TypeError(f'Cannot delete schema field {key} of a Row.')
+        if self._extra is None:
+            raise KeyError(key)
+        del self._extra[key]
+
+    def __contains__(self, key):
+        return key in self._schema or (self._extra is not None and key in self._extra)
+
+    def __iter__(self):
+        yield from self._schema
+        if self._extra is not None:
+            yield from self._extra
+
+    def __len__(self):
+        return len(self._schema) + (len(self._extra) if self._extra is not None else 0)
+
+    def __eq__(self, other):
+        return isinstance(other, Mapping) and dict(self.items()) == dict(other.items())
+
+    def __repr__(self):
+        return f'Row({dict(self.items())})'
+
+    def __reduce__(self):
+        return (_row, (self._schema, self._values, self._extra))
+
+
+def _row(schema, values, extra):
+    row = Row(schema, values)
+    row._extra = extra
+    return row
+
+
+# Decode a query response body (bytes), its records stripped of "attributes"
+# by page_records. Compact pages are decoded with orjson when available.
+def decode_page(content, compact=False, schemas=None):
+    results = (_loads(content) if compact else json.loads(content))
+    results['records'] = page_records(results['records'], compact, schemas)
+    return results
+
+
+# Return the records of a decoded query page without "attributes". Dictionaries
+# are copied without their top level "attributes", as before compact records;
+# nested relationship records keep theirs. With compact, records become Rows
+# sharing one schema per distinct field list (nested relationship records stay
+# dictionaries, stripped as well); the decoded dictionaries are stripped in
+# place and dropped.
+def page_records(records, compact=False, schemas=None):
+    if not compact:
+        return [{key: value for key, value in record.items() if key != 'attributes'}
+                for record in records]
+    schemas = ({} if schemas is None else schemas)
+    rows = []
+    for record in records:
+        _strip(record)
+        keys = tuple(record)
+        schema = schemas.get(keys)
+        if schema is None:
+            schema = schemas[keys] = {key: i for i, key in enumerate(keys)}
+        rows.append(Row(schema, tuple(record.values())))
+    return rows
+
+
+def _strip(record):
+    record.pop('attributes', None)
+    for value in record.values():
+        if type(value) is dict:
+            _strip(value)
+    return record
+
+
+# json.dumps default for records: Rows as dictionaries, anything else as a string.
+def json_default(value):
+    if isinstance(value, Mapping):
+        return dict(value)
+    return str(value)
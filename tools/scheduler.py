@@ -0,0 +1,180 @@
+__author__ = 'Stephen Stokes: sstokes[at]relationshipvelocity.com'
+
+import itertools
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+log = logging.getLogger(__name__)
+
+
+# Map each template row index to the set of row indexes it depends on.
+# A row depends on earlier rows loading an object it references through its
+# relationships, and on earlier rows for the same object. Only earlier rows are
+# considered, so the graph is always acyclic and respects the template order
+# chosen for cyclic references.
+def build_dependencies(rows):
+    dependencies = {}
+    for i, row in enumerate(rows):
+        relationships = (row['relationships']
+                         if 'relationships' in row else [])
+        referenced = {rel['object'] for rel in relationships}
+        referenced.add(row['object'])
+        dependencies[i] = {j for j in range(i)
+                           if rows[j]['object'] in referenced}
+
+    return dependencies
+
+
+# Invert a dependency map, e.g. to delete children before their parents.
+def reverse_dependencies(dependencies):
+    reverse = {node: set() for node in dependencies}
+    for node, deps in dependencies.items():
+        for dep in deps:
+            reverse[dep].add(node)
+
+    return reverse
+
+
+# Return the nodes of a dependency map in topological order, ties broken by node order.
+def topological_order(dependencies):
+    remaining = {node: set(deps) for node, deps in dependencies.items()}
+    order = []
+    while remaining:
+        ready = sorted(node for node, deps in remaining.items() if not deps)
+        if not ready:
+            raise ValueError(
+                f'Dependency cycle between {sorted(remaining)}.')
+        for node in ready:
+            order.append(node)
+            del remaining[node]
+        for deps in remaining.values():
+            deps.difference_update(ready)
+
+    return order
+
+
+# Call func(node) for every node once all of its dependencies have finished,
+# running independent nodes concurrently on up to max_workers threads.
+def run_dag(dependencies, func, max_workers=4):
+    topological_order(dependencies)
+    remaining = {node: set(deps) for node, deps in dependencies.items()}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running = {}
+        while remaining or running:
+            for node in sorted(node for node, deps in remaining.items() if not deps):
+                del remaining[node]
+                running[executor.submit(func, node)] = node
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                node = running.pop(future)
+                # Stop scheduling on the first failure; running nodes finish first.
+                future.result()
+                log.debug(f'run_dag node {node} completed.')
+                for deps in remaining.values():
+                    deps.discard(node)
+
+
+# Return the strongly connected components of graph ({node: set of nodes it
+# references}), each a list of nodes, referenced components before referencing ones.
+def strongly_connected_components(graph):
+    index, low, on_stack, stack, components = {}, {}, set(), [], []
+    for root in graph:
+        if root in index:
+            continue
+        # Iterative Tarjan: (node, iterator over its references).
+        work = [(root, iter(sorted(graph[root])))]
+        index[root] = low[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        while work:
+            node, references = work[-1]
+            reference = next(references, None)
+            if reference is not None:
+                if reference not in graph:
+                    continue
+                if reference not in index:
+                    index[reference] = low[reference] = len(index)
+                    stack.append(reference)
+                    on_stack.add(reference)
+                    work.append((reference, iter(sorted(graph[reference]))))
+                elif reference in on_stack:
+                    low[node] = min(low[node], index[reference])
+                continue
+            work.pop()
+            if work:
+                low[work[-1][0]] = min(low[work[-1][0]], low[node])
+            if low[node] == index[node]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    component.append(member)
+                    if member == node:
+                        break
+                components.append(component)
+
+    return components
+
+
+# Order the nodes of graph ({node: set of nodes it references}) so referenced
+# nodes come first, larger nodes (by weight, e.g. record counts) first among
+# those ready. Nodes of a cycle are ordered to minimize the total weight of
+# nodes left referencing nodes that come after them; self references are
+# ignored. Return (order, {node: set of later nodes it references}).
+def cycle_order(graph, weights=None, max_exact=8):
+    weights = (weights or {})
+    graph = {node: {ref for ref in refs if ref in graph and ref != node}
+             for node, refs in graph.items()}
+    position = {node: i for i, node in enumerate(graph)}
+    components = strongly_connected_components(graph)
+    component_of = {node: i for i, component in enumerate(components) for node in component}
+    dependencies = {i: {component_of[ref] for node in component for ref in graph[node]} - {i}
+                    for i, component in enumerate(components)}
+
+    order = []
+    remaining = {i: set(deps) for i, deps in dependencies.items()}
+    while remaining:
+        ready = [i for i, deps in remaining.items() if not deps]
+        # Largest component first, then template order.
+        i = min(ready, key=lambda i: (-sum(weights.get(node, 0) for node in components[i]),
+                                      min(position[node] for node in components[i])))
+        order.extend(_component_order(components[i], graph, weights, position, max_exact))
+        del remaining[i]
+        for deps in remaining.values():
+            deps.discard(i)
+
+    loaded = {node: i for i, node in enumerate(order)}
+    back_edges = {node: {ref for ref in graph[node] if loaded[ref] > loaded[node]}
+                  for node in order}
+    back_edges = {node: refs for node, refs in back_edges.items() if refs}
+    if back_edges:
+        log.info(f'Cyclic references loaded in a second pass: {back_edges}')
+
+    return order, back_edges
+
+
+def _component_order(component, graph, weights, position, max_exact):
+    component = sorted(component, key=lambda node: position[node])
+    if len(component) == 1:
+        return component
+
+    def _cost(order):
+        seen, cost = set(), 0
+        for node in reversed(order):
+            if graph[node] & seen:
+                cost += max(weights.get(node, 0), 1)
+            seen.add(node)
+        return cost
+
+    if len(component) <= max_exact:
+        return list(min(itertools.permutations(component), key=_cost))
+    # Greedy: next, the node whose unresolved references cost least.
+    order, remaining = [], list(component)
+    while remaining:
+        node = min(remaining, key=lambda node: (
+            (max(weights.get(node, 0), 1) if graph[node] & (set(remaining) - {node}) else 0),
+            -weights.get(node, 0), position[node]))
+        order.append(node)
+        remaining.remove(node)
+    log.debug(f'Cycle of {len(component)} objects ordered greedily: {order}')
+    return order
@@ -0,0 +1,238 @@
+__author__ = 'Andrew Shuler: ashuler[at]relationshipvelocity.com'
+
+import csv
+import io
+import logging
+import time
+
+import requests as r
+
+from tools import governor, metrics
+from tools.bulk_csv import CsvBatch
+from tools.sf_bulk_api import BatchResult, get_key_value
+
+# Bulk API 2.0 accepts up to 150MB of base64 encoded data per job upload,
+# which is roughly 100MB of CSV.
+MAX_UPLOAD_BYTES = 100 * 1024 * 1024
+
+
+class Connection(object):
+    def __init__(self, session_id, instance_url, api_version, reauth=None, query_connection=None):
+        """
+        Bulk API 2.0 ingest backend. Salesforce splits each uploaded CSV into batches server side,
+        so a load is a single upload per job of up to MAX_UPLOAD_BYTES.
+
+        :param session_id: Access token of an already authenticated session.
+        :type session_id: str
+        :param instance_url: Instance URL belonging to session_id, e.g. "https://na1.my.salesforce.com".
+        :type instance_url: str
+        :param api_version: REST API version, e.g. "48.0".
+        :type api_version: str
+        :param reauth: Callable taking the expired session id and returning a fresh one.
+        :type reauth: function
+        :param query_connection: sf_bulk_api.Connection used to look up Ids for Update jobs.
+        :type query_connection: sf_bulk_api.Connection
+        """
+        # Logging setup
+        self.log = logging.getLogger(__name__)
+        self._reauth = reauth
+        self._query_connection = query_connection
+        self.session_id = session_id
+        self.base_url = f'{instance_url}/services/data/v{api_version}/jobs/ingest'
+        self.org = governor.org_key(instance_url)
+        self.session = r.session()
+        self.session.headers.update(
+            {'Authorization': f'Bearer {session_id}'})
+        self.log.info(f'Reusing Salesforce session for {instance_url}.')
+
+    def _request(self, method, url, **kwargs):
+        # Send a request, re-authenticating once if the session has expired.
+        # Transient failures are retried with backoff by the rate governor.
+        session_id = self.session_id
+        response = governor.GOVERNOR.send(
+            self.org, lambda: self.session.request(method, url, **kwargs))
+        if response.status_code == 401 and self._reauth is not None:
+            self.log.info('Bulk session expired, re-authenticating.')
+            self.session_id = self._reauth(session_id)
+            self.session.headers.update(
+                {'Authorization': f'Bearer {self.session_id}'})
+            metrics.METRICS.retry()
+            response = governor.GOVERNOR.send(
+                self.org, lambda: self.session.request(method, url, **kwargs))
+        sent = kwargs.get('data')
+        metrics.METRICS.api_call((len(sent) if sent else 0) + len(response.content))
+        if response.status_code >= 400:
+            raise RuntimeError(
+                f'Bulk API 2.0 {method} {url} failed ({response.status_code}): {response.text}')
+        return response
+
+    def get_id_index(self, object_name, primary_key):
+        return self._query_connection.get_id_index(object_name, primary_key)
+
+    def clear_id_index(self, object_name=None):
+        if self._query_connection is not None:
+            self._query_connection.clear_id_index(object_name)
+
+    def run_bulk_job(self, job_type, object_name, batches, primary_key='', concurrency='Parallel',
+                     max_open=4, slots=None, min_poll=2, max_poll=30, timeout=60*60):
+        """
+        Load batches with Bulk API 2.0 and yield (rows, results) per job as it finishes. Client side
+        batches are concatenated into uploads of up to MAX_UPLOAD_BYTES, one job per upload.
+        rows are rebuilt from the downloaded successful, failed and unprocessed result files, so
+        rows[i] belongs to results[i]. Same interface as sf_bulk_api.Connection.run_bulk_job; the
+        concurrency mode is managed by Salesforce and ignored here.
+        """
+        job_type = str.title(job_type)
+        operations = {'Insert': 'insert', 'Update': 'update', 'Upsert': 'upsert',
+                      'Delete': 'delete', 'Harddelete': 'hardDelete'}
+        if job_type not in operations:
+            raise ReferenceError(
+                'Invalid job_type specified. Please use "Insert", "Update", "Upsert", "Delete" or "HardDelete".')
+        id_index = (self.get_id_index(object_name, primary_key)
+                    if job_type == 'Update' else None)
+
+        open_jobs = []
+        n_jobs = 0
+        try:
+            for body in self._uploads(batches, id_index, primary_key):
+                while len(open_jobs) >= max_open:
+                    yield from self._wait(object_name, open_jobs, min_poll, max_poll, timeout, slots)
+                if slots is not None:
+                    slots.acquire()
+                try:
+                    job = self._create_job(
+                        object_name, operations[job_type], primary_key)
+                    self._request('PUT', f'{self.base_url}/{job}/batches', data=body,
+                                  headers={'Content-Type': 'text/csv'})
+                    self._request('PATCH', f'{self.base_url}/{job}/',
+                                  json={'state': 'UploadComplete'})
+                except Exception:
+                    if slots is not None:
+                        slots.release()
+                    raise
+                open_jobs.append(job)
+                n_jobs += 1
+            while open_jobs:
+                yield from self._wait(object_name, open_jobs, min_poll, max_poll, timeout, slots)
+        finally:
+            # Hand back the slots of jobs still open on early exit.
+            if slots is not None:
+                for _ in open_jobs:
+                    slots.release()
+        self.log.info(
+            f'{job_type} {object_name} Bulk API 2.0 load completed with {n_jobs} jobs.')
+
+    def _create_job(self, object_name, operation, primary_key):
+        payload = {
+            'object': object_name,
+            'operation': operation,
+            'contentType': 'CSV',
+            'lineEnding': 'LF'
+        }
+        if operation == 'upsert':
+            payload['externalIdFieldName'] = primary_key
+        job = self._request('POST', f'{self.base_url}/', json=payload).json()
+        self.log.info(f'Created {object_name} {operation} job {job["id"]}.')
+        return job['id']
+
+    def _uploads(self, batches, id_index=None, primary_key=''):
+        # Encode batches as CSV and cut them into upload bodies of up to MAX_UPLOAD_BYTES.
+        fieldnames = None
+        header = b''
+        chunks = []
+        size = 0
+        for rows in batches:
+            if not rows:
+                continue
+            if id_index is not None:
+                rows = list(rows)
+                for rec in rows:
+                    rec['Id'] = id_index.get(get_key_value(rec, primary_key))
+            if isinstance(rows, CsvBatch):
+                # Pre-encoded CSV batches share one header.
+                if fieldnames is None:
+                    fieldnames = rows.header
+                    header = bytes(rows.header)
+                    size = len(header)
+                body = bytes(rows.body)
+            else:
+                if fieldnames is None:
+                    fieldnames = list(rows[0].keys())
+                    header = encode_csv([dict(zip(fieldnames, fieldnames))], fieldnames)
+                    size = len(header)
+                body = encode_csv(rows, fieldnames)
+            if chunks and size + len(body) > MAX_UPLOAD_BYTES:
+                yield b''.join([header] + chunks)
+                chunks = []
+                size = len(header)
+            chunks.append(body)
+            size += len(body)
+        if chunks:
+            yield b''.join([header] + chunks)
+
+    def _wait(self, object_name, open_jobs, min_poll, max_poll, timeout, slots=None):
+        # Poll the open jobs with backoff until at least one finishes, then yield its results.
+        # Finished jobs hand back their slot.
+        interval = min_poll
+        deadline = time.time() + timeout
+        while True:
+            finished = []
+            for job in open_jobs:
+                with metrics.METRICS.timer(object_name, 'poll'):
+                    info = self._request('GET', f'{self.base_url}/{job}/').json()
+                if info['state'] in ['JobComplete', 'Failed', 'Aborted']:
+                    finished.append((job, info))
+            if finished:
+                break
+            if time.time() > deadline:
+                raise TimeoutError(
+                    f'Bulk API 2.0 jobs {open_jobs} did not finish within {timeout} seconds.')
+            time.sleep(interval)
+            interval = min(interval * 1.5, max_poll)
+        for job, info in finished:
+            open_jobs.remove(job)
+            if slots is not None:
+                slots.release()
+            self.log.info(
+                f'Job {job} {info["state"]}: {info.get("numberRecordsProcessed")} processed, '
+                f'{info.get("numberRecordsFailed")} failed.')
+            with metrics.METRICS.timer(object_name, 'poll'):
+                results = self.get_job_results(job, info)
+            yield results
+
+    def get_job_results(self, job, info=None):
+        """ Download the successful, failed and unprocessed records of a job as (rows, results). """
+        rows = []
+        results = []
+        for row in self._get_csv(f'{self.base_url}/{job}/successfulResults/'):
+            results.append(BatchResult(row.pop('sf__Id'), 'true',
+                                       row.pop('sf__Created'), None))
+            rows.append(row)
+        for row in self._get_csv(f'{self.base_url}/{job}/failedResults/'):
+            results.append(BatchResult(row.pop('sf__Id') or None, 'false',
+                                       'false', row.pop('sf__Error')))
+            rows.append(row)
+        message = ((info.get('errorMessage') if info else None)
+                   or 'Record was not processed.')
+        for row in self._get_csv(f'{self.base_url}/{job}/unprocessedrecords/'):
+            results.append(BatchResult(None, 'false', 'false', message))
+            rows.append(row)
+        return rows, results
+
+    def _get_csv(self, url):
+        response = self._request('GET', url)
+        response.encoding = 'utf-8'
+        return csv.DictReader(io.StringIO(response.text))
+
+    def close_connection(self):
+        self.session.close()
+        self.log.info('Closed connection to Salesforce Bulk API 2.0')
+
+
+# Encode rows as CSV bytes without a header, None becoming an empty value.
+def encode_csv(rows, fieldnames):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fieldnames,
+                            lineterminator='\n', extrasaction='ignore')
+    writer.writerows(rows)
+    return buffer.getvalue().encode('utf-8')
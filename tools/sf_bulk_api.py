@@ -1,16 +1,31 @@
 __author__ = 'Andrew Shuler: ashuler[at]relationshipvelocity.com'
 
 import csv
-import json
+import io
 import logging
+import queue
+import threading
+import time
+from collections import namedtuple
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 
-from salesforce_bulk import CsvDictsAdapter, SalesforceBulk
-from salesforce_bulk.util import IteratorBytesIO
+from salesforce_bulk import BulkApiError, SalesforceBulk
+
+from tools import governor, metrics
+from tools.bulk_csv import CsvBatch, dicts_batch
+
+# Shape of salesforce_bulk batch results, used for batches that failed as a whole.
+BatchResult = namedtuple('BatchResult', 'id success created error')
 
 
 class Connection(object):
-    def __init__(self, username, password, security_token, sandbox=True):
+    def __init__(self, username=None, password=None, security_token=None, sandbox=True,
+                 session_id=None, instance_url=None, api_version=None, reauth=None):
         """
+        Either username, password and security_token or an existing session_id and instance_url
+        (e.g. the access token of a sf_rest_api.Connection) must be provided.
+
         :param username:
         :type username: str
         :param password:
@@ -19,33 +34,69 @@ class Connection(object):
         :type security_token: str
         :param sandbox: Whether the Salesforce Instance is Production or Sandbox. Default value is False (Production).
         :type sandbox: bool
+        :param session_id: Access token of an already authenticated session.
+        :type session_id: str
+        :param instance_url: Instance URL belonging to session_id.
+        :type instance_url: str
+        :param api_version: Bulk API version, e.g. "48.0".
+        :type api_version: str
+        :param reauth: Callable taking the expired session id and returning a fresh one.
+        :type reauth: function
         """
         # Logging setup
         self.log = logging.getLogger(__name__)
-        self.log.info('Signing into Salesforce.')
+        self._reauth = reauth
+        self._id_indexes = {}
+        self._id_index_locks = {}
+        self._id_index_lock = threading.Lock()
         try:
-            self.bulk = SalesforceBulk(username=username, password=password,
-                                       security_token=security_token, sandbox=sandbox)
-            self.log.info(
-                f'Successfully connected to Salesforce as "{username}".')
+            if session_id:
+                _kwargs = ({'API_version': api_version} if api_version else {})
+                self.bulk = SalesforceBulk(
+                    sessionId=session_id, host=instance_url, **_kwargs)
+                self.log.info(
+                    f'Reusing Salesforce session for {instance_url}.')
+            else:
+                self.log.info('Signing into Salesforce.')
+                self.bulk = SalesforceBulk(username=username, password=password,
+                                           security_token=security_token, sandbox=sandbox)
+                self.log.info(
+                    f'Successfully connected to Salesforce as "{username}".')
         except Exception as auth_err:
             self.log.exception(
                 f'Failed to connect to Salesforce: {auth_err}')
             raise
+        self.org = governor.org_key(instance_url or getattr(self.bulk, 'endpoint', ''))
+
+    def _call(self, func, *args, batches=0, **kwargs):
+        # Run a salesforce_bulk call, re-authenticating once if the session has expired.
+        # Transient failures are retried with backoff by the rate governor.
+        session_id = self.bulk.sessionId
+        metrics.METRICS.api_call()
+        try:
+            return governor.GOVERNOR.call(self.org, lambda: func(*args, **kwargs),
+                                          is_transient=is_transient_error, batches=batches)
+        except BulkApiError as bulk_err:
+            if self._reauth is None or 'InvalidSessionId' not in str(bulk_err):
+                raise
+            self.log.info('Bulk session expired, re-authenticating.')
+            self.bulk.sessionId = self._reauth(session_id)
+            metrics.METRICS.retry()
+            return governor.GOVERNOR.call(self.org, lambda: func(*args, **kwargs),
+                                          is_transient=is_transient_error, batches=batches)
 
     def create_and_run_delete_job(self, object_name, data):
-        job = self.bulk.create_delete_job(object_name, contentType='CSV')
-        # Transform data from list of dictionaries into iterable CSV Content Type,
-        # since the salesforce_bulk package provides a sweet class for it.
-        csv_iter = CsvDictsAdapter(iter(data))
+        job = self._call(self.bulk.create_delete_job, object_name, contentType='CSV')
+        # Transform data from list of dictionaries into CSV bytes, which can be posted again on retry.
+        csv_iter = dicts_batch(data).data
         # Create a batch with the data and add it to the job.
-        batch = self.bulk.post_batch(job, csv_iter)
+        batch = self._call(self.bulk.post_batch, job, csv_iter)
         # Wait for the batch to complete. Default timeout is 10 minutes.
-        self.bulk.wait_for_batch(job, batch, timeout=60 * 10)
+        self._call(self.bulk.wait_for_batch, job, batch, timeout=60 * 10)
         # Once the batch has been completed, get the results.
-        results = self.bulk.get_batch_results(batch)
+        results = self._call(self.bulk.get_batch_results, batch)
         # Close the Job.
-        self.bulk.close_job(job)
+        self._call(self.bulk.close_job, job)
         self.log.info(
             f'Delete {object_name} job has been successfully completed.')
         return results
@@ -77,35 +128,17 @@ class Connection(object):
                 'Invalid job_type not specified. Please use "Insert", "Update", or "Upsert".')
         try:
             if job_type == 'Insert':
-                job = self.bulk.create_insert_job(
-                    object_name, contentType='CSV')
+                job = self._call(self.bulk.create_insert_job,
+                                 object_name, contentType='CSV')
             elif job_type == 'Update':
-                job = self.bulk.create_update_job(
-                    object_name, contentType='CSV')
-                soql_query = f'select Id, {primary_key} from {object_name}'
-                query_job = self.bulk.create_query_job(
-                    object_name, contentType='CSV')
-                query_batch = self.bulk.query(query_job, soql_query)
-                self.bulk.close_job(query_job)
-                self.bulk.wait_for_batch(query_job, query_batch, timeout=60*10)
-                query_results = list(
-                    self.bulk.get_all_results_for_query_batch(query_batch))
-                if len(query_results) == 1:
-                    id_map = json.load(IteratorBytesIO(query_results[0]))
-                    for rec in data:
-                        for row in id_map:
-                            if primary_key not in row:
-                                key_split = primary_key.split('.')
-                                row[primary_key] = row[key_split[0]][key_split[1]]
-                            if rec[primary_key] == row[primary_key]:
-                                rec['Id'] = row['Id']
-                                break
-                else:
-                    raise OverflowError(
-                        'Query Results larger than expected. Please review.')
+                job = self._call(self.bulk.create_update_job,
+                                 object_name, contentType='CSV')
+                id_index = self.get_id_index(object_name, primary_key)
+                for rec in data:
+                    rec['Id'] = id_index.get(get_key_value(rec, primary_key))
             elif job_type == 'Upsert':
-                job = self.bulk.create_upsert_job(
-                    object_name, external_id_name=primary_key, contentType='CSV')
+                job = self._call(self.bulk.create_upsert_job,
+                                 object_name, external_id_name=primary_key, contentType='CSV')
         except Exception as job_creation_error:
             self.log.info(
                 f'Unable to create {object_name} {job_type} Job. Please verify the value of the object_name variable.')
@@ -113,17 +146,326 @@ class Connection(object):
                 f'Encountered exception when creating job: {job_creation_error}')
             raise
 
-        # Transform data from list of dictionaries into iterable CSV Content Type,
-        # since the salesforce_bulk package provides a sweet class for it.
-        csv_iter = CsvDictsAdapter(iter(data))
+        # Transform data from list of dictionaries into CSV bytes, which can be posted again on retry.
+        csv_iter = dicts_batch(data).data
         # Create a batch with the data and add it to the job.
-        batch = self.bulk.post_batch(job, csv_iter)
+        batch = self._call(self.bulk.post_batch, job, csv_iter)
         # Wait for the batch to complete. Default timeout is 10 minutes.
-        self.bulk.wait_for_batch(job, batch, timeout=60*10)
+        self._call(self.bulk.wait_for_batch, job, batch, timeout=60*10)
         # Once the batch has been completed, get the results.
-        results = self.bulk.get_batch_results(batch)
+        results = self._call(self.bulk.get_batch_results, batch)
         # Close the Job.
-        self.bulk.close_job(job)
+        self._call(self.bulk.close_job, job)
         self.log.info(
             f'{job_type}, {object_name}, job has been successfully completed.')
         return results
+
+    def run_bulk_job(self, job_type, object_name, batches, primary_key='', concurrency='Parallel',
+                     max_open=40, slots=None, post_threads=4, min_poll=2, max_poll=30, timeout=60*60):
+        """
+        Run all batches through a single Bulk API job and yield (rows, results) for each batch as it finishes.
+        Batches are posted from a background thread pool while this generator polls the state of every
+        open batch with one batch-list request per cycle, backing off from min_poll to max_poll seconds
+        while nothing changes.
+
+        :param job_type: "Insert", "Update", "Upsert", "Delete" or "HardDelete".
+        :type job_type: str
+        :param object_name: The Name of the SF Object, e.g. "Account".
+        :type object_name: str
+        :param batches: Iterable of lists of dictionaries or of bulk_csv.CsvBatch; may be a lazy generator.
+        :type batches: iterable
+        :param primary_key: External Id field for Upsert, or the key used to look up Ids for Update.
+        :type primary_key: str
+        :param concurrency: Job concurrency mode, "Parallel" or "Serial".
+        :type concurrency: str
+        :param max_open: Maximum number of posted batches waiting for results.
+        :type max_open: int
+        :param slots: Optional semaphore shared between jobs, acquired for every open batch.
+        :type slots: threading.Semaphore
+        """
+        job_type = str.title(job_type)
+        operations = {'Insert': 'insert', 'Update': 'update', 'Upsert': 'upsert',
+                      'Delete': 'delete', 'Harddelete': 'hardDelete'}
+        if job_type not in operations:
+            raise ReferenceError(
+                'Invalid job_type specified. Please use "Insert", "Update", "Upsert", "Delete" or "HardDelete".')
+        self.log.info(f'Creating {object_name} {job_type} job.')
+        job = self._call(self.bulk.create_job, object_name, operation=operations[job_type], contentType='CSV',
+                         concurrency=concurrency,
+                         external_id_name=(primary_key if job_type == 'Upsert' else None))
+        id_index = (self.get_id_index(object_name, primary_key)
+                    if job_type == 'Update' else None)
+
+        open_batches = {}
+        lock = threading.Lock()
+        open_slots = threading.BoundedSemaphore(max_open)
+        # Posting threads count their calls against the caller's object and phase.
+        context = metrics.METRICS.current()
+        posting_done = threading.Event()
+        aborted = threading.Event()
+        post_errors = []
+
+        def post(rows):
+            try:
+                if id_index is not None:
+                    rows = list(rows)
+                    for rec in rows:
+                        rec['Id'] = id_index.get(get_key_value(rec, primary_key))
+                # Pre-encoded CSV batches are posted as they are. Data is posted as
+                # bytes so a retried post sends it again.
+                with metrics.METRICS.context(*context):
+                    data = (rows if isinstance(rows, CsvBatch) else dicts_batch(rows)).data
+                    metrics.METRICS.add(*context, n_bytes=len(data))
+                    batch = self._call(self.bulk.post_batch, job, data, batches=1)
+                with lock:
+                    open_batches[batch] = rows
+            except Exception as post_err:
+                post_errors.append(post_err)
+                release()
+
+        def release():
+            open_slots.release()
+            if slots is not None:
+                slots.release()
+
+        def acquire(semaphore):
+            # Wait for a free slot, giving up once the job is aborted.
+            while not semaphore.acquire(timeout=1):
+                if aborted.is_set():
+                    return False
+            return True
+
+        def poster():
+            try:
+                with ThreadPoolExecutor(max_workers=post_threads) as executor:
+                    for rows in batches:
+                        if post_errors or not acquire(open_slots):
+                            break
+                        if slots is not None and not acquire(slots):
+                            open_slots.release()
+                            break
+                        executor.submit(post, rows)
+            except Exception as batch_err:
+                post_errors.append(batch_err)
+            finally:
+                posting_done.set()
+
+        poster_thread = threading.Thread(target=poster, daemon=True)
+        poster_thread.start()
+        interval = min_poll
+        deadline = time.time() + timeout
+        n_batches = 0
+        try:
+            while True:
+                if post_errors:
+                    raise post_errors[0]
+                done = posting_done.is_set()
+                with lock:
+                    waiting = dict(open_batches)
+                if done and not waiting:
+                    break
+                progress = False
+                if waiting:
+                    with metrics.METRICS.timer(object_name, 'poll'):
+                        states = {b['id']: b for b in self._call(
+                            self.bulk.get_batch_list, job)}
+                    for batch, rows in waiting.items():
+                        info = (states[batch] if batch in states else {})
+                        state = (info['state'] if 'state' in info else '')
+                        if state not in ['Completed', 'Failed', 'NotProcessed']:
+                            continue
+                        if state == 'Completed':
+                            with metrics.METRICS.timer(object_name, 'poll'):
+                                results = self._call(
+                                    self.bulk.get_batch_results, batch, job)
+                        else:
+                            message = (info['stateMessage']
+                                       if 'stateMessage' in info else state)
+                            results = [BatchResult(None, 'false', 'false', message)
+                                       for _ in rows]
+                        with lock:
+                            del open_batches[batch]
+                        release()
+                        n_batches += 1
+                        progress = True
+                        yield rows, results
+                if progress or not waiting:
+                    interval = min_poll
+                    deadline = time.time() + timeout
+                else:
+                    interval = min(interval * 1.5, max_poll)
+                if time.time() > deadline:
+                    raise TimeoutError(
+                        f'{object_name} {job_type} job made no progress for {timeout} seconds.')
+                if not progress:
+                    time.sleep(interval)
+        finally:
+            # On early exit stop posting and hand back the slots of batches still open.
+            aborted.set()
+            poster_thread.join()
+            with lock:
+                for _ in open_batches:
+                    release()
+                open_batches.clear()
+            self._call(self.bulk.close_job, job)
+        self.log.info(
+            f'{job_type} {object_name} job completed with {n_batches} batches.')
+
+    def get_id_index(self, object_name, primary_key):
+        """
+        Return a dictionary of primary_key value -> Id for all object_name records. The index is built
+        once with a Bulk API query (all result chunks) and shared by every batch and thread using this
+        connection until clear_id_index is called. primary_key may be a relationship path (Parent.Key__c).
+        """
+        cache_key = (object_name.lower(), primary_key.lower())
+        with self._id_index_lock:
+            lock = self._id_index_locks.setdefault(cache_key, threading.Lock())
+        with lock:
+            if cache_key not in self._id_indexes:
+                soql_query = f'select Id, {primary_key} from {object_name}'
+                id_index = {}
+                for page in self.query_iter(object_name, soql_query, pk_chunking=False):
+                    for row in page:
+                        id_index[get_key_value(row, primary_key)] = row['Id']
+                id_index.pop(None, None)
+                self.log.info(
+                    f'Built {object_name} {primary_key} index with {len(id_index)} keys.')
+                self._id_indexes[cache_key] = id_index
+            return self._id_indexes[cache_key]
+
+    def clear_id_index(self, object_name=None):
+        with self._id_index_lock:
+            for cache_key in list(self._id_indexes):
+                if object_name is None or cache_key[0] == object_name.lower():
+                    del self._id_indexes[cache_key]
+
+    def query_iter(self, object_name, soql_query, pk_chunking=True, thread_count=4, page_size=2000):
+        """
+        Run soql_query as a Bulk API query job and yield the results as pages (lists of dictionaries).
+        With pk_chunking, Salesforce splits the extraction into batches by Id range. Result files of all
+        batches are downloaded in parallel and parsed as a stream, so only a few pages are held in memory.
+
+        Relationship columns (e.g. "Parent.Legacy_ID__c") are nested and empty values returned as None,
+        matching the shape of sf_rest_api.Connection.soql_query records.
+        """
+        self.log.info(
+            f'Creating {object_name} query job (pk_chunking={pk_chunking}).')
+        job = self._call(self.bulk.create_query_job, object_name,
+                         contentType='CSV', pk_chunking=pk_chunking)
+        batch = self._call(self.bulk.query, job, soql_query)
+        self._call(self.bulk.close_job, job)
+        batch_ids = self.wait_for_query_batches(job, batch, timeout=60*30)
+        results = [(batch_id, result_id)
+                   for batch_id in batch_ids
+                   for result_id in self._call(self.bulk.get_query_batch_result_ids, batch_id, job_id=job)]
+        self.log.debug(f'{object_name} query job result files: {len(results)}')
+
+        pages = queue.Queue(maxsize=thread_count * 2)
+        stop = threading.Event()
+        context = metrics.METRICS.current()
+
+        def download(batch_id, result_id):
+            try:
+                with metrics.METRICS.context(*context):
+                    chunks = self._call(self.bulk.get_query_batch_results,
+                                        batch_id, result_id, job_id=job)
+                # get_query_batch_results already returns a readable IteratorBytesIO.
+                reader = csv.DictReader(io.TextIOWrapper(chunks, encoding='utf-8'))
+                page = []
+                for row in reader:
+                    page.append(unflatten_row(row))
+                    if len(page) >= page_size:
+                        if stop.is_set():
+                            return
+                        pages.put(page)
+                        page = []
+                if page:
+                    pages.put(page)
+            except Exception as download_err:
+                pages.put(download_err)
+                return
+            finally:
+                pages.put(None)
+
+        n_records = 0
+        n_open = len(results)
+        with ThreadPoolExecutor(max_workers=thread_count) as executor:
+            for batch_id, result_id in results:
+                executor.submit(download, batch_id, result_id)
+            try:
+                while n_open > 0:
+                    page = pages.get()
+                    if page is None:
+                        n_open -= 1
+                    elif isinstance(page, Exception):
+                        raise page
+                    else:
+                        n_records += len(page)
+                        yield page
+            finally:
+                # Unblock downloads if the consumer stopped early or a download failed.
+                stop.set()
+                while n_open > 0:
+                    if pages.get() is None:
+                        n_open -= 1
+        self.log.info(
+            f'{object_name} query job returned {n_records} records.')
+
+    def wait_for_query_batches(self, job, batch, timeout=60*10, sleep_interval=10):
+        """
+        Wait for a query job to finish and return the ids of the batches holding results. For
+        PK-chunked jobs the original batch ends as NotProcessed and the chunk batches carry the results.
+        """
+        deadline = time.time() + timeout
+        while True:
+            batches = self._call(self.bulk.get_batch_list, job)
+            states = {b['id']: b['state'] for b in batches}
+            failed = [b for b in batches if b['state'] == 'Failed']
+            if failed:
+                raise RuntimeError(
+                    f'Query batch failed: {failed[0].get("stateMessage")}')
+            chunked = (states.get(batch) == 'NotProcessed')
+            result_ids = ([b_id for b_id in states if b_id != batch]
+                          if chunked else [batch])
+            if (chunked or states.get(batch) == 'Completed') and \
+                    all(states[b_id] == 'Completed' for b_id in result_ids):
+                return result_ids
+            if time.time() > deadline:
+                raise TimeoutError(
+                    f'Query job {job} did not finish within {timeout} seconds.')
+            time.sleep(sleep_interval)
+
+
+# Convert a Bulk API CSV row into the nested shape returned by the REST API.
+def unflatten_row(row, separator='.'):
+    record = {}
+    for key, value in row.items():
+        value = (value if value != '' else None)
+        *parents, field = key.split(separator)
+        nested = record
+        for parent in parents:
+            if nested.get(parent) is None:
+                nested[parent] = {}
+            nested = nested[parent]
+        nested[field] = value
+    return record
+
+
+# Whether a salesforce_bulk error is a rate limit or outage worth retrying.
+def is_transient_error(bulk_err):
+    if not isinstance(bulk_err, BulkApiError):
+        return False
+    return (getattr(bulk_err, 'status_code', None) in governor.TRANSIENT_STATUS
+            or governor.is_transient_message(bulk_err))
+
+
+# Return the value of key in record, following dotted relationship paths through nested dictionaries.
+def get_key_value(record, key, separator='.'):
+    if key in record:
+        return record[key]
+    value = record
+    for part in key.split(separator):
+        if not isinstance(value, Mapping):
+            return None
+        value = value.get(part)
+    return value
@@ -1,17 +1,36 @@
 __author__ = 'Andrew Shuler: ashuler[at]relationshipvelocity.com'
 
+import heapq
 import json
 import logging
+import queue
+import threading
+from collections import namedtuple
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 
 import requests as r
+from requests.adapters import HTTPAdapter
+
+from tools import governor, metrics
+from tools.describe_cache import DESCRIBES
+from tools.records import decode_page
+
+# Store query records as compact Rows instead of dictionaries (tools.records).
+COMPACT_RECORDS = False
+# sObject Collections limits; results mirror the bulk API's BatchResult.
+COLLECTION_SIZE = 200
+COLLECTION_JOB_TYPES = ['Insert', 'Upsert', 'Delete']
+CollectionResult = namedtuple('CollectionResult', 'id success created error')
 
 
 class Connection(object):
-    def __init__(self, username, password, grant_type, client_id, client_secret, sandbox=True):
+    def __init__(self, username, password, grant_type, client_id, client_secret, sandbox=True, pool_size=10):
         # Logging setup
         self.log = logging.getLogger(__name__)
         # create non-JSON dict object with all other configuration params.
-        payload = {
+        self._payload = {
             'grant_type': grant_type,
             'client_id': client_id,
             'client_secret': client_secret,
@@ -19,68 +38,229 @@ class Connection(object):
             'password': password
         }
         if sandbox:
-            login_url = 'https://test.salesforce.com/services/oauth2/token'
+            self._login_url = 'https://test.salesforce.com/services/oauth2/token'
         else:
-            login_url = 'https://login.salesforce.com/services/oauth2/token'
-        # start session.
+            self._login_url = 'https://login.salesforce.com/services/oauth2/token'
+        self._login_lock = threading.Lock()
+        # start session, keeping up to pool_size connections open for concurrent requests.
         self.session = r.session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=pool_size,
+                                                   pool_maxsize=pool_size))
         # authenticate into SF.
+        self.login()
+        self.base_url = self.instance_url + '/services/data'
+        # get the latest valid Salesforce API Version.
+        self.api_version = self.session.get(self.base_url).json()[-1]['version']
+        # extend the base_url to include the standard API path prefix and the version number.
+        self.base_url += f'/v{self.api_version}'
+        # daily limits of the org are checked by the shared rate governor.
+        governor.GOVERNOR.register(self.org, self.get_limits)
+
+    def login(self):
         login = self.session.post(
-            login_url,
-            data=payload,
+            self._login_url,
+            data=self._payload,
             headers={'Content-Type': 'application/x-www-form-urlencoded'},
             timeout=None
         ).json()
         # upon successful authentication, get instance URL and access token from the login response JSON.
         try:
             self.instance_url = login['instance_url']
-            self.base_url = self.instance_url + '/services/data'
+            self.access_token = login['access_token']
+            self.org = governor.org_key(self.instance_url)
             # update Authorization session header with value "Bearer {access_token}"
             self.session.headers.update(
-                {'Authorization': f'Bearer {login["access_token"]}'})
+                {'Authorization': f'Bearer {self.access_token}'})
             self.log.info(f'Successfully connected to {self.instance_url}.')
         except Exception as login_error:
             self.log.exception(
                 f'Failed to connect to SF instance.\nError: {login_error}')
             raise
-        # get the latest valid Salesforce API Version.
-        version = self.session.get(self.base_url).json()[-1]['version']
-        # extend the base_url to include the standard API path prefix and the version number.
-        self.base_url += f'/v{version}'
+
+    def refresh_session(self, stale_token=None):
+        """ Re-authenticate, unless another thread already replaced stale_token. Returns the access token. """
+        with self._login_lock:
+            if stale_token is None or stale_token == self.access_token:
+                self.log.info('Session expired, re-authenticating.')
+                self.login()
+        return self.access_token
+
+    def _get(self, url, **kwargs):
+        return self._request('GET', url, **kwargs)
+
+    def _request(self, method, url, **kwargs):
+        # transient failures are retried with backoff by the rate governor.
+        token = self.access_token
+        response = governor.GOVERNOR.send(
+            self.org, lambda: self.session.request(method, url, **kwargs))
+        if response.status_code == 401:
+            self.refresh_session(token)
+            metrics.METRICS.retry()
+            response = governor.GOVERNOR.send(
+                self.org, lambda: self.session.request(method, url, **kwargs))
+        metrics.METRICS.api_call(len(response.content))
+        return response
 
     def soql_query(self, query_string):
         """ Response JSON has 3 keys: totalSize, done, records. """
+        records = [
+            record
+            for page in self.soql_query_iter(query_string)
+            for record in page
+        ]
+        self.log.info(f'SOQL query returned {len(records)} records.')
+        return records
+
+    def soql_query_iter(self, query_string, query_all=False):
+        """
+        Yield the query results one page (list of records) at a time, following nextRecordsUrl lazily.
+        query_all includes deleted and archived records (queryAll endpoint).
+        """
         try:
             # Encode and execute soql query
-            raw_query = self.base_url + f'/query/?q={query_string}'
+            endpoint = ('/queryAll/' if query_all else '/query/')
+            raw_query = self.base_url + f'{endpoint}?q={query_string}'
             enc_query = raw_query #r.utils.requote_uri(raw_query)
             self.log.debug(enc_query)
-            results = self.session.get(enc_query).json()
-            if int(results['totalSize']) > 0:
-                records = [
-                    {key: value for key, value in record.items() if key !=
-                     'attributes'}
-                    for record in results['records']
-                ]
-                while 'nextRecordsUrl' in results:
-                    next_url = results['nextRecordsUrl']
-                    results = self.session.get(
-                        self.instance_url + next_url).json()
-                    # self.log.debug(f'Results: {results}')
-                    records.extend(
-                        {key: value for key, value in record.items() if key !=
-                         'attributes'}
-                        for record in results['records']
-                    )
-            else:
-                records = []
-            self.log.info(f'SOQL query returned {len(records)} records.')
-            return records
+            next_url = enc_query
+            # Records of all pages share their Row schemas.
+            schemas = {}
+            while next_url:
+                results = decode_page(self._get(next_url).content, COMPACT_RECORDS, schemas)
+                records = results['records']
+                if records:
+                    yield records
+                next_url = (self.instance_url + results['nextRecordsUrl']
+                            if 'nextRecordsUrl' in results else None)
         except Exception as soql_err:
             self.log.exception(
                 f'Failed to execute SOQL query "{query_string}".\nError: {soql_err}')
             raise
 
+    def soql_query_ranges(self, object_name, select, where='', order_by='', workers=4, range_field='CreatedDate',
+                          page_size=2000):
+        """
+        Yield the pages of "select <select> from <object_name> where <where> order by <order_by>", split into
+        `workers` ranges of range_field that are fetched concurrently. Range boundaries come from a single
+        min/max pre-query. With order_by the ranges are merged back into order (strings compare case
+        insensitively, like SOQL); otherwise pages are yielded as they arrive.
+        """
+        order = parse_order_by(order_by)
+        if order is None:
+            self.log.info(f'Cannot merge ranges ordered by "{order_by}", querying {object_name} sequentially.')
+            yield from self.soql_query_iter(build_query(select, object_name, where, order_by))
+            return
+        bounds = self._range_bounds(object_name, range_field, where, workers)
+        if not bounds:
+            yield from self.soql_query_iter(build_query(select, object_name, where, order_by))
+            return
+        # Records without a range_field value first, then one range per interval.
+        conditions = [f'{range_field} = null', f'{range_field} < {bounds[0]}']
+        conditions += [f'{range_field} >= {low} and {range_field} < {high}'
+                       for low, high in zip(bounds, bounds[1:])]
+        conditions.append(f'{range_field} >= {bounds[-1]}')
+        queries = [build_query(select, object_name, ' and '.join(([f'({where})'] if where else []) + [condition]),
+                               order_by)
+                   for condition in conditions]
+        self.log.info(f'Querying {object_name} in {len(queries)} {range_field} ranges.')
+
+        stop = threading.Event()
+        context = metrics.METRICS.current()
+
+        def put(out, item):
+            while not stop.is_set():
+                try:
+                    out.put(item, timeout=1)
+                    return
+                except queue.Full:
+                    continue
+
+        def fetch(query, out):
+            try:
+                with metrics.METRICS.context(*context):
+                    for page in self.soql_query_iter(query):
+                        if stop.is_set():
+                            return
+                        put(out, page)
+            except Exception as fetch_err:
+                put(out, fetch_err)
+            finally:
+                put(out, None)
+
+        def drain(out):
+            while True:
+                page = out.get()
+                if page is None:
+                    return
+                if isinstance(page, Exception):
+                    raise page
+                yield page
+
+        executor = ThreadPoolExecutor(max_workers=len(queries))
+        try:
+            if not order[0]:
+                # Unordered: pages of all ranges share one queue.
+                pages = queue.Queue(maxsize=len(queries) * 2)
+                for query in queries:
+                    executor.submit(fetch, query, pages)
+                n_done = 0
+                while n_done < len(queries):
+                    page = pages.get()
+                    if page is None:
+                        n_done += 1
+                    elif isinstance(page, Exception):
+                        raise page
+                    else:
+                        yield page
+                return
+            outs = [queue.Queue(maxsize=2) for _ in queries]
+            for query, out in zip(queries, outs):
+                executor.submit(fetch, query, out)
+            streams = [(record for page in drain(out) for record in page) for out in outs]
+            fields, descending = order
+            if [field.lower() for field in fields] == [range_field.lower()] and not descending:
+                # The ranges are already in range_field order.
+                records = (record for stream in streams for record in stream)
+            else:
+                records = heapq.merge(*streams, key=order_key(fields), reverse=descending)
+            page = []
+            for record in records:
+                page.append(record)
+                if len(page) >= page_size:
+                    yield page
+                    page = []
+            if page:
+                yield page
+        finally:
+            stop.set()
+            executor.shutdown(wait=False)
+
+    def _range_bounds(self, object_name, range_field, where, workers):
+        # Return the inner boundaries of `workers` equal range_field intervals, as SOQL literals.
+        query = build_query(f'min({range_field}) low, max({range_field}) high', object_name, where)
+        record = self._get(self.base_url + f'/query/?q={query}').json()['records'][0]
+        if record['low'] is None or record['low'] == record['high']:
+            return []
+        low, high = parse_soql_value(record['low']), parse_soql_value(record['high'])
+        step = (high - low) / workers
+        is_date = (len(record['low']) == 10)
+        bounds = []
+        for i in range(1, workers):
+            bound = low + step * i
+            bounds.append(bound.strftime('%Y-%m-%d') if is_date
+                          else bound.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'))
+        return sorted(set(bounds))
+
+    def soql_count(self, query_string):
+        """ Return totalSize of a "select count() ..." query. """
+        try:
+            results = self._get(self.base_url + f'/query/?q={query_string}').json()
+            return int(results['totalSize'])
+        except Exception as soql_err:
+            self.log.exception(
+                f'Failed to execute SOQL count "{query_string}".\nError: {soql_err}')
+            raise
+
     def describe_fields(self, sobject, print_keys=False):
         try:
             fields = [
@@ -109,24 +289,45 @@ class Connection(object):
 
     def describe_object(self, sobject, key, fields=[], print_keys=False):
         try:
-            details = self.session.get(
-                self.base_url + '/sobjects/{}/describe'.format(sobject)).json()[key]
+            details = self.describe(sobject)[key]
             if print_keys:
                 self.log.info(f'{key} keys\n\t{details[0].keys()}')
-            for record in details:
-                [record.pop(_key) for _key in list(record.keys())
-                 if fields and _key not in fields]
-                record.update({'sobject': sobject})
-            return details
+            # Copy the cached records, keeping only the requested keys.
+            return [dict({_key: value for _key, value in record.items()
+                          if not fields or _key in fields}, sobject=sobject)
+                    for record in details]
         except Exception as describe_err:
             raise ValueError(
                 f'Failed to describe "{sobject}".\nError: {describe_err}')
 
+    def describe(self, sobject):
+        """ Return the full describe JSON of sobject from the describe cache, revalidated with ETag/If-Modified-Since. """
+        cached = DESCRIBES.get(self.org, sobject)
+        if cached is not None and DESCRIBES.is_fresh(self.org, sobject):
+            return cached['describe']
+        response = self._get(self.base_url + f'/sobjects/{sobject}/describe',
+                             headers=(DESCRIBES.headers(self.org, sobject) if cached is not None else {}))
+        if response.status_code == 304:
+            DESCRIBES.touch(self.org, sobject)
+            return cached['describe']
+        if not response.ok:
+            raise ValueError(f'HTTP {response.status_code}: {response.text}')
+        describe = response.json()
+        DESCRIBES.put(self.org, sobject, describe,
+                      response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        return describe
+
+    def describe_objects(self, sobjects, workers=10):
+        """ Describe sobjects concurrently over the pooled session. Returns {sobject: describe}. """
+        sobjects = list(dict.fromkeys(sobjects))
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(sobjects)))) as executor:
+            return dict(zip(sobjects, executor.map(self.describe, sobjects)))
+
     def get_response(self, url):
         try:
             session_url = self.base_url + url
             self.log.debug(f'URL: {session_url}')
-            results = self.session.get(session_url)
+            results = self._get(session_url)
 
             return results
         except Exception as describe_err:
@@ -134,6 +335,124 @@ class Connection(object):
                 f'Failed to get results.\nError: {describe_err}')
             raise
 
+    def load_collection(self, job_type, object_name, records, primary_key='', workers=4, slots=None):
+        """
+        Insert, upsert (on external id primary_key) or delete records through the sObject Collections
+        endpoints, 200 records per request, with requests sent concurrently over the pooled session.
+        Records are flat dictionaries as for a bulk job: "Parent.UUID__c" columns become nested
+        relationship references and empty values are left out, leaving the fields unchanged like a
+        blank bulk CSV value. Yields (rows, results) per request, results being CollectionResults in row order.
+        slots is an optional semaphore shared with bulk jobs, acquired for every request in flight.
+        """
+        if job_type not in COLLECTION_JOB_TYPES:
+            raise ValueError(f'{job_type} is not supported by sObject Collections.')
+        chunks = [records[i:i + COLLECTION_SIZE]
+                  for i in range(0, len(records), COLLECTION_SIZE)]
+        def request(rows):
+            if slots is not None:
+                slots.acquire()
+            try:
+                return rows, self._collection_request(job_type, object_name, rows, primary_key)
+            finally:
+                if slots is not None:
+                    slots.release()
+
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(chunks)))) as executor:
+            yield from executor.map(request, chunks)
+
+    def _collection_request(self, job_type, object_name, rows, primary_key):
+        url = self.base_url + '/composite/sobjects'
+        if job_type == 'Delete':
+            response = self._request('DELETE', url, params={'ids': ','.join(row[primary_key or 'Id'] for row in rows),
+                                                            'allOrNone': 'false'})
+        else:
+            body = {'allOrNone': False,
+                    'records': [collection_record(object_name, row) for row in rows]}
+            if job_type == 'Upsert':
+                response = self._request('PATCH', url + f'/{object_name}/{primary_key}', json=body)
+            else:
+                response = self._request('POST', url, json=body)
+        if not response.ok:
+            raise ValueError(f'{object_name} {job_type} collection failed: HTTP {response.status_code} '
+                             f'{response.text}')
+        return [CollectionResult(result['id'] if 'id' in result else None,
+                            ('true' if result['success'] else 'false'),
+                            ('true' if 'created' in result and result['created'] else 'false'),
+                            '; '.join(f'{error["statusCode"]}:{error["message"]}'
+                                      for error in (result['errors'] if 'errors' in result else [])))
+                for result in response.json()]
+
+    def get_limits(self):
+        """ Return the org's limits, e.g. {"DailyApiRequests": {"Max": 15000, "Remaining": 14000}, ...}. """
+        return self._get(self.base_url + '/limits/').json()
+
     def close_connection(self):
         self.session.close()
         self.log.info('Closed connection to Salesforce REST API')
+
+
+# Return a flat bulk record as a sObject Collections record: "Parent.UUID__c"
+# columns become {"Parent": {"UUID__c": ...}} and empty values are left out.
+def collection_record(object_name, row):
+    record = {'attributes': {'type': object_name}}
+    for column, value in row.items():
+        if value is None or value == '':
+            continue
+        if '.' in column:
+            relationship, field = column.split('.', 1)
+            record.setdefault(relationship, {})[field] = value
+        else:
+            record[column] = value
+    return record
+
+
+def build_query(select, object_name, where='', order_by=''):
+    return (f'select {select} from {object_name}'
+            + (f' where {where}' if where else '')
+            + (f' order by {order_by}' if order_by else ''))
+
+
+# Return (fields, descending) of an order by clause, ([], False) without one, or None
+# when ranges cannot be merged in Python (mixed directions or explicit nulls ordering).
+def parse_order_by(order_by):
+    fields = []
+    directions = set()
+    for part in [part.split() for part in order_by.split(',') if part.strip()]:
+        if len(part) > 2:
+            return None
+        fields.append(part[0])
+        directions.add(len(part) == 2 and part[1].lower() == 'desc')
+    if len(directions) > 1:
+        return None
+    return fields, (directions.pop() if directions else False)
+
+
+# Return a sort key of records on fields (paths such as "Parent.Name"); nulls sort first.
+def order_key(fields):
+    paths = [field.split('.') for field in fields]
+
+    def key(record):
+        values = []
+        for path in paths:
+            value = record
+            for part in path:
+                value = (get_ignore_case(value, part) if isinstance(value, Mapping) else None)
+            value = (value.lower() if isinstance(value, str) else value)
+            values.append((value is not None, value if value is not None else 0))
+        return values
+    return key
+
+
+# Return record[key], matching key case insensitively like SOQL field names.
+def get_ignore_case(record, key):
+    if key in record:
+        return record[key]
+    key = key.lower()
+    return next((value for k, value in record.items() if k.lower() == key), None)
+
+
+# Parse a SOQL date or datetime value, e.g. "2020-01-31" or "2020-01-31T10:00:00.000+0000".
+def parse_soql_value(value):
+    if len(value) == 10:
+        return datetime.strptime(value, '%Y-%m-%d')
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f%z')
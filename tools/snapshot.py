@@ -0,0 +1,116 @@
+__author__ = 'Stephen Stokes: sstokes[at]relationshipvelocity.com'
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from tools.records import json_default
+
+log = logging.getLogger(__name__)
+
+
+# On-disk cache of source extractions, so one extraction can seed several
+# targets and re-runs skip the source org. Each snapshot is a gzip compressed
+# JSON lines file (one page per line, keeping nested relationship records and
+# nulls intact); manifest.json maps the snapshot key to its file and metadata.
+class SnapshotCache(object):
+    def __init__(self, path='./cache/snapshots', ttl_hours=24, max_mb=2048):
+        self.path = path
+        self.ttl = ttl_hours * 3600
+        self.max_bytes = max_mb * 1024 * 1024
+        self._lock = threading.Lock()
+        self._manifest_path = os.path.join(path, 'manifest.json')
+
+    # Return the snapshot key of an extraction.
+    @staticmethod
+    def key(**parts):
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    # Return an iterator of pages for key, or None when missing or expired.
+    def read(self, key):
+        with self._lock:
+            manifest = self._load()
+            entry = (manifest[key] if key in manifest else None)
+            if entry is None:
+                return None
+            if time.time() - entry['created'] > self.ttl or \
+                    not os.path.exists(os.path.join(self.path, entry['file'])):
+                self._remove(manifest, key)
+                self._save(manifest)
+                return None
+            entry['last_used'] = time.time()
+            self._save(manifest)
+        log.info(
+            f'Reading {entry["records"]} {entry["object"]} records from snapshot {key[:12]}.')
+        return self._read_pages(os.path.join(self.path, entry['file']))
+
+    def _read_pages(self, file_path):
+        with gzip.open(file_path, 'rt', encoding='utf-8') as snapshot_file:
+            for line in snapshot_file:
+                yield json.loads(line)
+
+    # Pass pages through while writing them to a snapshot. The snapshot is only
+    # registered once the whole stream has been consumed.
+    def write(self, key, pages, **metadata):
+        os.makedirs(self.path, exist_ok=True)
+        file_name = f'{key}.jsonl.gz'
+        tmp_path = os.path.join(self.path, f'{key}.{threading.get_ident()}.tmp')
+        n_records = 0
+        try:
+            with gzip.open(tmp_path, 'wt', encoding='utf-8') as snapshot_file:
+                for page in pages:
+                    snapshot_file.write(json.dumps(page, default=json_default) + '\n')
+                    n_records += len(page)
+                    yield page
+            os.replace(tmp_path, os.path.join(self.path, file_name))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        with self._lock:
+            manifest = self._load()
+            manifest[key] = dict(metadata,
+                                 file=file_name,
+                                 records=n_records,
+                                 size=os.path.getsize(os.path.join(self.path, file_name)),
+                                 created=time.time(),
+                                 last_used=time.time())
+            self._evict(manifest)
+            self._save(manifest)
+        log.info(f'Saved {n_records} records to snapshot {key[:12]}.')
+
+    # Drop expired snapshots, then the least recently used ones until under max_bytes.
+    def _evict(self, manifest):
+        now = time.time()
+        for key in [k for k, v in manifest.items() if now - v['created'] > self.ttl]:
+            self._remove(manifest, key)
+        by_last_used = sorted(manifest, key=lambda k: manifest[k]['last_used'])
+        total = sum(entry['size'] for entry in manifest.values())
+        for key in by_last_used[:-1]:
+            if total <= self.max_bytes:
+                break
+            total -= manifest[key]['size']
+            self._remove(manifest, key)
+
+    def _remove(self, manifest, key):
+        file_path = os.path.join(self.path, manifest[key]['file'])
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        del manifest[key]
+        log.debug(f'Evicted snapshot {key[:12]}.')
+
+    def _load(self):
+        if not os.path.exists(self._manifest_path):
+            return {}
+        with open(self._manifest_path, 'r') as manifest_file:
+            return json.load(manifest_file)
+
+    def _save(self, manifest):
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = self._manifest_path + '.tmp'
+        with open(tmp_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+        os.replace(tmp_path, self._manifest_path)
@@ -0,0 +1,114 @@
+__author__ = 'Stephen Stokes: sstokes[at]relationshipvelocity.com'
+
+import json
+import logging
+import os
+import re
+import threading
+
+from tools import helpers as h
+
+log = logging.getLogger(__name__)
+
+# Bulk API limits and starting points.
+MIN_BATCH = 200
+MAX_BATCH = 10000
+DEFAULT_MAX_BATCH = 5000
+LOCK_ERROR = 'UNABLE_TO_LOCK_ROW'
+# Share of lock failures above which batch size and parallelism are halved.
+LOCK_ERROR_RATE = 0.01
+
+
+# Return the status code of a bulk result error, e.g. "UNABLE_TO_LOCK_ROW".
+def classify_error(error):
+    if not error:
+        return 'UNKNOWN'
+    match = re.match(r'\s*([A-Z_]{3,})', str(error))
+    return (match.group(1) if match else 'OTHER')
+
+
+# Learns bulk batch size and parallelism per org, object and operation from
+# observed throughput and lock errors, and keeps them in a JSON file for the
+# next run.
+class BulkTuner(object):
+    def __init__(self, path='./state/bulk_tuning.json'):
+        self.path = path
+        self._lock = threading.Lock()
+        self._settings = (h.get_config(path) if os.path.exists(path) else {})
+
+    # Return (chunk_size, thread_count) for a job.
+    def settings(self, org, object_name, job_type, n_records=None, thread=True):
+        max_threads = (10 if str.title(job_type) in ['Delete', 'Harddelete'] else 20)
+        max_threads = (max_threads if thread else 1)
+        with self._lock:
+            learned = self._get(org, object_name, job_type)
+        if learned:
+            return learned['chunk_size'], min(learned['thread_count'], max_threads)
+
+        if n_records is None:
+            return 2000, max_threads
+        # Spread the records over all threads, rounded up to whole min batches.
+        chunk_size = n_records // max_threads
+        chunk_size = MIN_BATCH - (chunk_size % MIN_BATCH) + chunk_size
+        chunk_size = (DEFAULT_MAX_BATCH if chunk_size > DEFAULT_MAX_BATCH else chunk_size)
+        return chunk_size, max_threads
+
+    # Return the records/sec of the last job learned, or None.
+    def throughput(self, org, object_name, job_type):
+        with self._lock:
+            learned = self._get(org, object_name, job_type)
+        return (learned['records_per_sec'] if learned else None)
+
+    # Record the outcome of a job and adjust the settings for the next one.
+    def record(self, org, object_name, job_type, chunk_size, thread_count, n_records, seconds, errors):
+        if n_records < MIN_BATCH or seconds <= 0:
+            return
+        records_per_sec = n_records / seconds
+        n_lock = (errors[LOCK_ERROR] if LOCK_ERROR in errors else 0)
+        with self._lock:
+            learned = self._get(org, object_name, job_type) or {}
+            best = (learned['best'] if 'best' in learned else None)
+            if n_lock / n_records > LOCK_ERROR_RATE:
+                # Contention: smaller batches, fewer concurrent batches.
+                chunk_size = max(MIN_BATCH, chunk_size // 2)
+                thread_count = max(1, thread_count // 2)
+                reason = f'{n_lock} lock errors'
+            elif best and records_per_sec < best['records_per_sec'] * 0.9:
+                # Slower than the best run so far: go back to those settings.
+                chunk_size = best['chunk_size']
+                thread_count = best['thread_count']
+                reason = 'throughput dropped'
+            else:
+                if not best or records_per_sec >= best['records_per_sec']:
+                    best = {'chunk_size': chunk_size,
+                            'thread_count': thread_count,
+                            'records_per_sec': round(records_per_sec, 1)}
+                chunk_size = min(MAX_BATCH, -(-chunk_size * 5 // 4 // MIN_BATCH) * MIN_BATCH)
+                thread_count = thread_count + 2
+                reason = 'no contention'
+            learned = {
+                'chunk_size': chunk_size,
+                'thread_count': thread_count,
+                'records_per_sec': round(records_per_sec, 1),
+                'best': best,
+                'updated': h.dtm().isoformat()
+            }
+            self._settings.setdefault(org, {}).setdefault(
+                object_name, {})[job_type] = learned
+            self._save()
+        log.info(
+            f'{org} {object_name} {job_type}: {records_per_sec:.1f} records/sec, {reason} - '
+            f'next chunk_size {chunk_size}, thread_count {thread_count}.')
+
+    def _get(self, org, object_name, job_type):
+        try:
+            return self._settings[org][object_name][job_type]
+        except KeyError:
+            return None
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as json_file:
+            json.dump(self._settings, json_file, indent=2)
+        os.replace(tmp_path, self.path)
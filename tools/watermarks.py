@@ -0,0 +1,51 @@
+__author__ = 'Stephen Stokes: sstokes[at]relationshipvelocity.com'
+
+import os
+import sqlite3
+import threading
+
+
+# High-water marks of incremental loads, one per source org, target org and object,
+# kept in a local SQLite database.
+class WatermarkStore(object):
+    def __init__(self, path='./state/tdm_state.db'):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        conn = sqlite3.connect(self.path)
+        conn.execute('create table if not exists watermarks ('
+                     'source text, target text, object text, watermark text, updated text, '
+                     'primary key (source, target, object))')
+        return conn
+
+    def get(self, source, target, object_name):
+        with self._lock:
+            conn = self._connect()
+            try:
+                row = conn.execute('select watermark from watermarks where source = ? and target = ? and object = ?',
+                                   (source, target, object_name)).fetchone()
+            finally:
+                conn.close()
+        return (row[0] if row else None)
+
+    def set(self, source, target, object_name, watermark):
+        with self._lock:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.execute('insert or replace into watermarks values (?, ?, ?, ?, datetime(\'now\'))',
+                                 (source, target, object_name, watermark))
+            finally:
+                conn.close()
+
+    def clear(self, source, target, object_name):
+        with self._lock:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.execute('delete from watermarks where source = ? and target = ? and object = ?',
+                                 (source, target, object_name))
+            finally:
+                conn.close()